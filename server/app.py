@@ -14,6 +14,7 @@ if str(project_root) not in sys.path:
 
 from server.config import FLASK_SECRET
 from server.db import init_db
+from server.utils import ORJSON_AVAILABLE, ORJSONProvider
 from server.routers import auth, tasks, calendar, emails, settings
 
 # Configure logging
@@ -36,6 +37,8 @@ logger = logging.getLogger(__name__)
 # Create Flask app
 app = Flask(__name__)
 app.secret_key = FLASK_SECRET
+if ORJSON_AVAILABLE:
+    app.json = ORJSONProvider(app)
 # For cross-domain cookies (frontend and backend on different domains)
 if os.getenv('FLASK_ENV') == 'production':
     app.config['SESSION_COOKIE_SAMESITE'] = 'None'
@@ -6,6 +6,10 @@ from dotenv import load_dotenv
 # Load .env from project root (parent directory)
 load_dotenv(dotenv_path=Path(__file__).parent.parent / '.env', override=False)
 
+# oauthlib refuses plain-http redirect URIs; allow them outside production, set once at startup
+if os.getenv("FLASK_ENV") != "production":
+    os.environ.setdefault("OAUTHLIB_INSECURE_TRANSPORT", "1")
+
 _google_client_secrets_json = os.getenv("GOOGLE_CLIENT_SECRETS_JSON")
 if not _google_client_secrets_json:
     raise ValueError("GOOGLE_CLIENT_SECRETS_JSON environment variable is required")
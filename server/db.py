@@ -3,7 +3,7 @@ import os
 from contextlib import contextmanager
 from datetime import datetime, timezone
 
-from sqlalchemy import create_engine, ForeignKey, UniqueConstraint, Integer, TypeDecorator
+from sqlalchemy import create_engine, event, inspect, text, ForeignKey, Index, UniqueConstraint, Integer, TypeDecorator
 from sqlalchemy.orm import registry, mapped_column, Mapped, Session, sessionmaker, relationship
 from sqlalchemy import JSON, BigInteger, Text, Boolean, TIMESTAMP
 from sqlalchemy.exc import OperationalError
@@ -49,7 +49,29 @@ class EncryptedString(TypeDecorator):
             # Return raw value if decryption fails (e.g. plain text data mixed with encrypted)
             return value
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True, future=True)
+# One pooled connection per gunicorn thread (see Dockerfile), with headroom for bursts
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "8"))
+
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=30,
+    # A local SQLite file never goes stale; pinging it would add a SELECT 1 to every checkout
+    pool_pre_ping=not DATABASE_URL.startswith("sqlite"),
+    future=True,
+)
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers run alongside the single writer; NORMAL sync is safe under WAL
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
 mapper_registry = registry()
 Base = mapper_registry.generate_base()
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
@@ -68,6 +90,8 @@ class User(Base):
     google_client_id: Mapped[str | None] = mapped_column(Text)
     google_client_secret: Mapped[str | None] = mapped_column(EncryptedString)
     google_scopes: Mapped[list[str] | None] = mapped_column(JSON)
+    # Naive UTC, as google-auth compares it; lets requests refresh an expired token before using it
+    google_token_expiry: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True), nullable=True)
     
     # Relationships
     emails: Mapped[list["Email"]] = relationship("Email", back_populates="user")
@@ -90,6 +114,9 @@ class Email(Base):
     processed: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
     first_processed_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True))
     last_processed_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True))
+    # Last ml_decide result and the server.ml.classification_version it was produced under
+    ml_result: Mapped[dict | None] = mapped_column(JSON, nullable=True)
+    ml_version: Mapped[str | None] = mapped_column(Text, nullable=True)
     created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), default=lambda: datetime.now(timezone.utc), nullable=False)
     updated_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), default=lambda: datetime.now(timezone.utc), nullable=False)
     
@@ -117,6 +144,11 @@ class Task(Base):
     user: Mapped["User"] = relationship("User", back_populates="tasks")
     email: Mapped["Email"] = relationship("Email")
 
+    __table_args__ = (
+        # GET /tasks/all reads a user's newest tasks; this serves the filter and the sort without a temp b-tree
+        Index('ix_tasks_user_created', 'user_id', 'created_at'),
+    )
+
 
 class CalendarEvent(Base):
     __tablename__ = "calendar_events"
@@ -148,6 +180,8 @@ class UserSettings(Base):
     task_categories: Mapped[list[str] | None] = mapped_column(JSON, nullable=True, default=list)
     calendar_categories: Mapped[list[str] | None] = mapped_column(JSON, nullable=True, default=list)
     auto_generate: Mapped[bool] = mapped_column(Boolean, nullable=False, default=True)
+    # Category prompt blocks preformatted by server.ml.build_prompt_context when categories are saved
+    prompt_context: Mapped[dict | None] = mapped_column(JSON, nullable=True)
     created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), default=lambda: datetime.now(timezone.utc), nullable=False)
     updated_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), default=lambda: datetime.now(timezone.utc), nullable=False, onupdate=lambda: datetime.now(timezone.utc))
     
@@ -168,9 +202,31 @@ def init_db():
     
     try:
         Base.metadata.create_all(engine, checkfirst=True)
+        add_missing_columns()
+        add_missing_indexes()
     except OperationalError:
         pass
 
+
+def add_missing_columns():
+    """create_all never alters existing tables; add nullable columns introduced since the database was created."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'))
+
+
+def add_missing_indexes():
+    """create_all only indexes the tables it creates; add indexes declared since on existing tables."""
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
 @contextmanager
 def db_session() -> Session:
     session = SessionLocal()
@@ -9,60 +9,255 @@ Uses OpenAI API to:
 
 from __future__ import annotations
 import os
+import atexit
+import copy
+import hashlib
+import importlib.util
 import json
 import re
 import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from html import unescape as html_unescape
 from typing import Dict, Any, Optional, Union
-from bs4 import BeautifulSoup
+from lxml import etree, html as lxml_html
 
 logger = logging.getLogger(__name__)
 
 try:
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so existing handlers still apply
+    from orjson import loads as json_loads
 except ImportError:
-    OPENAI_AVAILABLE = False
+    json_loads = json.loads
+
+# The SDK pulls in httpx, pydantic and friends, so only check it is installed here and
+# import it on first use; workers serving auth or task routes never pay for it
+OPENAI_AVAILABLE = importlib.util.find_spec("openai") is not None
+
+
+@lru_cache(maxsize=1)
+def openai_sdk():
+    import openai
+    return openai
+
+# One client per API key so calls reuse the SDK's pooled keep-alive connections
+_clients: Dict[str, Any] = {}
+_clients_lock = threading.Lock()
+
+
+def get_openai_client(api_key: str):
+    with _clients_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            client = openai_sdk().OpenAI(api_key=api_key, timeout=30.0, max_retries=2)
+            _clients[api_key] = client
+        return client
+
+
+@atexit.register
+def _close_openai_clients() -> None:
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute buckets shared by every thread in the process.
+
+    A limit of 0 disables that bucket. acquire() blocks until both buckets can cover the call.
+    clock and sleep default to time.monotonic and time.sleep; tests pass fakes.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, clock=time.monotonic, sleep=time.sleep):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = requests_per_minute
+        self._tokens = tokens_per_minute
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int) -> None:
+        # A single call larger than the whole bucket would otherwise wait forever
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                now = self._clock()
+                elapsed = now - self._updated
+                self._updated = now
+                if self.requests_per_minute:
+                    self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+                if self.tokens_per_minute:
+                    self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+                wait = 0.0
+                if self.requests_per_minute and self._requests < 1:
+                    wait = (1 - self._requests) * 60 / self.requests_per_minute
+                if self.tokens_per_minute and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+                if not wait:
+                    if self.requests_per_minute:
+                        self._requests -= 1
+                    if self.tokens_per_minute:
+                        self._tokens -= tokens
+                    return
+            self._sleep(wait)
+
+
+@lru_cache(maxsize=1)
+def get_rate_limiter() -> Optional[RateLimiter]:
+    """
+    Process-wide limiter from OPENAI_RPM / OPENAI_TPM, or None when neither is set.
+
+    The buckets are not shared between gunicorn workers or instances, so the limits
+    apply per worker process: set them to the account limit divided by the total
+    number of workers (two per instance in the Dockerfile).
+    """
+    try:
+        requests_per_minute = float(os.getenv("OPENAI_RPM") or 0)
+        tokens_per_minute = float(os.getenv("OPENAI_TPM") or 0)
+    except ValueError:
+        logger.warning("Ignoring invalid OPENAI_RPM/OPENAI_TPM values")
+        return None
+    if requests_per_minute <= 0 and tokens_per_minute <= 0:
+        return None
+    return RateLimiter(max(requests_per_minute, 0), max(tokens_per_minute, 0))
+
+
+def request_completion(api_key: str, model: str, system_prompt: str, user_prompt: str, max_tokens: int, response_format: Dict[str, Any]):
+    """
+    One chat completion, throttled by the shared rate limiter.
+
+    Transient failures (429, timeouts, connection errors) are retried by the SDK
+    client itself with jittered exponential backoff.
+    """
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        # Rough prompt size at ~4 characters per token, plus the most the reply may use
+        limiter.acquire((len(system_prompt) + len(user_prompt)) // 4 + max_tokens)
+    return get_openai_client(api_key).chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+        temperature=0,
+        max_tokens=max_tokens,
+        response_format=response_format,
+    )
+
+
+# In-process cache of successful classifications, keyed by a hash of everything the prompt depends on
+CLASSIFICATION_CACHE_SIZE = 512
+CLASSIFICATION_CACHE_TTL = 7 * 24 * 3600
+_classification_cache: OrderedDict[str, tuple[float, Dict[str, Any]]] = OrderedDict()
+_classification_cache_lock = threading.Lock()
+
+
+def classification_cache_key(model: str, task_categories: str, calendar_categories: str, sender: str, subject: str, body: str) -> str:
+    raw = json.dumps([model, task_categories, calendar_categories, sender, subject, body], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def get_cached_classification(key: str) -> Optional[Dict[str, Any]]:
+    with _classification_cache_lock:
+        entry = _classification_cache.get(key)
+        if entry is None:
+            return None
+        stored_at, result = entry
+        if time.monotonic() - stored_at > CLASSIFICATION_CACHE_TTL:
+            del _classification_cache[key]
+            return None
+        _classification_cache.move_to_end(key)
+    # Hand out a copy so callers can never modify the cached entry
+    return copy.deepcopy(result)
+
+
+def cache_classification(key: str, result: Dict[str, Any]) -> None:
+    with _classification_cache_lock:
+        _classification_cache[key] = (time.monotonic(), copy.deepcopy(result))
+        _classification_cache.move_to_end(key)
+        if len(_classification_cache) > CLASSIFICATION_CACHE_SIZE:
+            _classification_cache.popitem(last=False)
+
+
+# Elements whose end starts a new line in the extracted text; table cells and definition
+# lists included so receipt layouts like <td>Amount</td><td>$50</td> stay apart
+BLOCK_BREAK_XPATH = (
+    "//br|//p|//div|//li|//tr|//td|//th|//dt|//dd|//caption|//table|//ul|//ol|//dl"
+    "|//blockquote|//pre|//hr|//section|//article|//header|//footer|//h1|//h2|//h3|//h4|//h5|//h6"
+)
+# Inline elements get a space when nothing separates them from what follows (<a>Home</a><a>About</a>)
+INLINE_BREAK_XPATH = "//span|//a|//b|//strong|//i|//em|//u|//font|//label|//button|//img|//small|//sup|//sub"
+BODY_TAG_RE = re.compile(r'<body[\s>]', re.IGNORECASE)
+# prepare_email_content keeps 2000 characters of text; inline-styled table markup runs ~30x that
+MAX_HTML_CHARS = 65_536
 
 
 def clean_html_to_text(html: str) -> str:
     if not html or not html.strip():
         return ""
     
-    soup = BeautifulSoup(html, "lxml")
+    # No markup at all (plain text sent as text/html): entities are all there is to decode
+    if "<" not in html:
+        return join_nonblank_lines(html_unescape(html))
     
-    for element in soup(["script", "style", "meta", "link"]):
-        element.decompose()
+    # Skip <head> (inline CSS, tracking scripts) before parsing; fragments without <body> are parsed whole
+    body_tag = BODY_TAG_RE.search(html)
+    if body_tag:
+        html = html[body_tag.start():]
+    if len(html) > MAX_HTML_CHARS:
+        html = html[:MAX_HTML_CHARS]
     
-    for br in soup.find_all("br"):
-        br.replace_with("\n")
-    
-    for p in soup.find_all("p"):
-        p.insert_after("\n")
-    
-    for div in soup.find_all("div"):
-        div.insert_after("\n")
+    try:
+        try:
+            doc = lxml_html.fromstring(html)
+        except ValueError:
+            # lxml refuses str input that carries an XML encoding declaration
+            doc = lxml_html.fromstring(html.encode("utf-8"))
+    except etree.ParserError:
+        # lxml only gives up on documents with no content (comments, declarations)
+        return ""
     
-    text = soup.get_text("\n")
+    body = doc.find(".//body")
+    if body is not None:
+        doc = body
     
-    text = re.sub(r'\n\s*\n\s*\n+', '\n\n', text)
+    etree.strip_elements(doc, "script", "style", "meta", "link", with_tail=False)
     
-    lines = [line.strip() for line in text.split('\n')]
-    text = '\n'.join(line for line in lines if line)
+    for element in doc.xpath(BLOCK_BREAK_XPATH):
+        element.tail = "\n" + (element.tail or "")
+    for element in doc.xpath(INLINE_BREAK_XPATH):
+        if not element.tail:
+            element.tail = " "
     
-    return text.strip()
+    return join_nonblank_lines(doc.text_content())
+
+
+def join_nonblank_lines(text: str) -> str:
+    # Blank lines are dropped here, so runs of them need no separate collapsing pass
+    return '\n'.join(stripped for stripped in (line.strip() for line in text.splitlines()) if stripped)
 
 
 def prepare_email_content(payload: Dict[str, Any]) -> Dict[str, str]:
     """
     Prepare email content for ML processing.
-    Extracts and cleans subject, body, and snippet.
+    Extracts and cleans subject, body, and snippet, plus prompt_body (body falling back to snippet).
     """
     subject = payload.get("subject", "")
     body = payload.get("body", "")
     html = payload.get("html", "")
     snippet = payload.get("snippet", "")
     
-    if not body and html:
+    if not body and html and not payload.get("html_converted"):
         body = clean_html_to_text(html)
     
     if len(body) > 2000:
@@ -71,7 +266,9 @@ def prepare_email_content(payload: Dict[str, Any]) -> Dict[str, str]:
     return {
         "subject": subject,
         "body": body,
-        "snippet": snippet
+        "snippet": snippet,
+        # Text the prompt, cache key and fallback notes use, resolved once per email
+        "prompt_body": body or snippet,
     }
 
 
@@ -90,26 +287,344 @@ def normalize_categories(raw: list[str] | list[dict] | None) -> list[dict[str, s
     if not raw:
         return []
     
-    normalized = []
+    # Fast path: the stored settings format is a plain list of names
+    if all(isinstance(item, str) for item in raw):
+        return [{"name": name, "description": ""} for item in raw if (name := item.strip())]
+    
+    return [
+        {"name": name, "description": description.strip() if isinstance(description, str) else ""}
+        for name, description in map(_category_fields, raw)
+        if name
+    ]
+
+
+def _category_fields(item: str | dict) -> tuple[str, Any]:
+    """(stripped name, raw description) of one category entry; the name is "" for unusable entries."""
+    if isinstance(item, str):
+        return item.strip(), ""
+    if isinstance(item, dict):
+        # Try 'name' first, then 'label' as fallback
+        name = item.get("name") or item.get("label") or ""
+        if isinstance(name, str):
+            return name.strip(), item.get("description", "")
+    return "", ""
+
+
+# Emails packed into one completion by ml_decide_batch; OPENAI_BATCH_SIZE overrides
+ML_BATCH_SIZE = 10
+# Completions ml_decide_batch keeps in flight at once; OPENAI_CONCURRENCY overrides
+ML_CONCURRENCY = 4
+
+# Output budget per classified email: title, a few sentences of notes, one line of reasoning and the meeting block
+MAX_TOKENS_PER_EMAIL = 250
+
+PROMPT_INSTRUCTIONS = """You are an email assistant that turns emails into tasks and calendar meetings.
+
+{task_categories_block}
+
+{calendar_categories_block}
+
+For each email decide:
+1. Task: should_create is true for action items or requests, reminders or deadlines, bills or payments due, follow-ups, delegated work, meeting invitations requiring preparation, and information that needs review or a response. It is false for newsletters, marketing, spam or promotions, social media and other automated notifications, purely informational or "FYI only" mail, and auto-replies or out-of-office messages.
+   - title: actionable (start with a verb if appropriate), 3-8 words, under 60 characters, without "RE:"/"FWD:" prefixes
+   - notes: 2-4 sentences with the key details, dates and requirements
+   - confidence: 0.0-1.0
+   - reasoning: one short sentence
+2. Meeting: is_meeting is true for meeting invitations (clues: "meeting", "invite", "agenda", "call", "Zoom", "conference", "link"). Extract summary, location (physical place or virtual link), start_datetime and end_datetime as RFC3339 UTC, and participants as email addresses. Leave unknown values empty.
+3. "category" and meeting "category": the EXACT name of one of the Available Task Categories and Available Calendar Categories respectively (no description, colon or extra text), or null if none fit.
+"""
+
+RESULT_FORMAT = (
+    '{"should_create": true/false, "confidence": 0.0-1.0, "title": "", "notes": "", '
+    '"category": "name or null", "reasoning": "", '
+    '"meeting": {"is_meeting": true/false, "summary": "", "location": "", "start_datetime": "", '
+    '"end_datetime": "", "participants": [], "category": "name or null"}}'
+)
+
+# Structured-output schemas mirroring RESULT_FORMAT; strict mode makes the API return exactly this shape
+MEETING_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_meeting": {"type": "boolean"},
+        "summary": {"type": "string"},
+        "location": {"type": "string"},
+        "start_datetime": {"type": "string"},
+        "end_datetime": {"type": "string"},
+        "participants": {"type": "array", "items": {"type": "string"}},
+        "category": {"type": ["string", "null"]},
+    },
+    "required": ["is_meeting", "summary", "location", "start_datetime", "end_datetime", "participants", "category"],
+    "additionalProperties": False,
+}
+CLASSIFICATION_PROPERTIES = {
+    "should_create": {"type": "boolean"},
+    "confidence": {"type": "number"},
+    "title": {"type": "string"},
+    "notes": {"type": "string"},
+    "category": {"type": ["string", "null"]},
+    "reasoning": {"type": "string"},
+    "meeting": MEETING_SCHEMA,
+}
+CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": CLASSIFICATION_PROPERTIES,
+    "required": list(CLASSIFICATION_PROPERTIES),
+    "additionalProperties": False,
+}
+BATCH_CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"index": {"type": "integer"}, **CLASSIFICATION_PROPERTIES},
+                "required": ["index", *CLASSIFICATION_PROPERTIES],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["results"],
+    "additionalProperties": False,
+}
+SINGLE_RESPONSE_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {"name": "email_classification", "strict": True, "schema": CLASSIFICATION_SCHEMA},
+}
+BATCH_RESPONSE_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {"name": "email_classifications", "strict": True, "schema": BATCH_CLASSIFICATION_SCHEMA},
+}
+
+
+def freeze_categories(raw: list[str] | list[dict] | None) -> tuple[tuple[str, str], ...]:
+    """Hashable (name, description) form of a category list, used as the prompt block cache key."""
+    if not raw:
+        return ()
+    frozen = []
     for item in raw:
         if isinstance(item, str):
-            # Simple string category
-            if item.strip():
-                normalized.append({"name": item.strip(), "description": ""})
+            frozen.append((item, ""))
         elif isinstance(item, dict):
-            # Rich category object
-            # Try 'name' first, then 'label' as fallback
             name = item.get("name") or item.get("label") or ""
-            if name and isinstance(name, str) and name.strip():
-                description = item.get("description", "")
-                if not isinstance(description, str):
-                    description = ""
-                normalized.append({
-                    "name": name.strip(),
-                    "description": description.strip() if description else ""
-                })
-    
-    return normalized
+            description = item.get("description", "")
+            frozen.append((name if isinstance(name, str) else "", description if isinstance(description, str) else ""))
+    return tuple(frozen)
+
+
+@lru_cache(maxsize=32)
+def build_category_blocks(task_cats_frozen: tuple[tuple[str, str], ...], cal_cats_frozen: tuple[tuple[str, str], ...]) -> tuple[str, str]:
+    """Normalize both category lists and format them as prompt blocks; categories rarely change, so this is memoized."""
+    normalized_task_cats = normalize_categories([{"name": name, "description": description} for name, description in task_cats_frozen])
+    normalized_cal_cats = normalize_categories([{"name": name, "description": description} for name, description in cal_cats_frozen])
+
+    # Log normalized categories for debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Normalized task categories: %d categories (%d) with descriptions",
+            len(normalized_task_cats), sum(1 for c in normalized_task_cats if c["description"]),
+        )
+        logger.debug(
+            "Normalized calendar categories: %d categories (%d) with descriptions",
+            len(normalized_cal_cats), sum(1 for c in normalized_cal_cats if c["description"]),
+        )
+
+    # Format categories as blocks for prompt
+    if normalized_task_cats:
+        task_categories_block = "Available Task Categories:\n" + "\n".join(
+            f"  - {cat['name']}" + (f": {cat['description']}" if cat['description'] else "")
+            for cat in normalized_task_cats
+        )
+    else:
+        task_categories_block = "Available Task Categories: None"
+
+    if normalized_cal_cats:
+        calendar_categories_block = "Available Calendar Categories:\n" + "\n".join(
+            f"  - {cat['name']}" + (f": {cat['description']}" if cat['description'] else "")
+            for cat in normalized_cal_cats
+        )
+    else:
+        calendar_categories_block = "Available Calendar Categories: None"
+
+    return task_categories_block, calendar_categories_block
+
+
+# Bump when build_category_blocks changes its output, so stored prompt contexts get rebuilt
+PROMPT_CONTEXT_VERSION = 1
+
+
+def build_prompt_context(task_categories: list[str] | list[dict] | None, calendar_categories: list[str] | list[dict] | None) -> Dict[str, Any]:
+    """
+    Preformatted category blocks for a user, stored with their settings when categories are saved.
+
+    Only the category blocks are persisted, not the full system prompt, so instruction
+    changes take effect without rewriting every user's settings.
+    """
+    task_categories_block, calendar_categories_block = build_category_blocks(
+        freeze_categories(task_categories), freeze_categories(calendar_categories)
+    )
+    return {
+        "version": PROMPT_CONTEXT_VERSION,
+        "task_categories_block": task_categories_block,
+        "calendar_categories_block": calendar_categories_block,
+    }
+
+
+def is_current_prompt_context(prompt_context: Optional[Dict[str, Any]]) -> bool:
+    return isinstance(prompt_context, dict) and prompt_context.get("version") == PROMPT_CONTEXT_VERSION
+
+
+def resolve_category_blocks(
+    task_categories: list[str] | list[dict] | None,
+    calendar_categories: list[str] | list[dict] | None,
+    prompt_context: Optional[Dict[str, Any]] = None,
+) -> tuple[str, str]:
+    if is_current_prompt_context(prompt_context):
+        return prompt_context["task_categories_block"], prompt_context["calendar_categories_block"]
+    return build_category_blocks(freeze_categories(task_categories), freeze_categories(calendar_categories))
+
+
+SINGLE_RESPONSE_FORMAT = "Respond ONLY with valid JSON in this exact format:\n"
+BATCH_RESPONSE_FORMAT = (
+    'Classify each email independently. Respond ONLY with valid JSON of the form {"results": [...]}, '
+    'with one object per email in the order given. Each object must include "index" (the email number) '
+    "and otherwise follow this exact format:\n"
+)
+
+
+@lru_cache(maxsize=32)
+def build_system_prompt(task_categories_block: str, calendar_categories_block: str, batched: bool = False) -> str:
+    """Everything except the emails themselves, kept byte-identical across calls so OpenAI can cache the prefix."""
+    return (
+        PROMPT_INSTRUCTIONS.format(
+            task_categories_block=task_categories_block,
+            calendar_categories_block=calendar_categories_block,
+        )
+        + "\n"
+        + (BATCH_RESPONSE_FORMAT if batched else SINGLE_RESPONSE_FORMAT)
+        + RESULT_FORMAT
+    )
+
+
+def format_email_block(email_content: Dict[str, str], sender: str, index: Optional[int] = None) -> str:
+    heading = f"Email #{index}:" if index is not None else "Email Details:"
+    return (
+        f"{heading}\n"
+        f"From: {sender}\n"
+        f"Subject: {email_content['subject']}\n\n"
+        f"Body:\n"
+        f"{email_content['prompt_body']}\n"
+    )
+
+
+def email_cache_key(model: str, task_categories_block: str, calendar_categories_block: str, email_content: Dict[str, str], sender: str) -> str:
+    return classification_cache_key(
+        model,
+        task_categories_block,
+        calendar_categories_block,
+        sender,
+        email_content.get("subject", "(No subject)"),
+        email_content["prompt_body"],
+    )
+
+
+def classification_version(
+    task_categories: list[str] | list[dict] | None,
+    calendar_categories: list[str] | list[dict] | None,
+    prompt_context: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Digest of everything besides the email that decides a classification; a stored result with a different version is stale.
+
+    Covers the prompt, the models, and the rules that skip the model (heuristic rules and mode,
+    MIN_CONTENT_CHARS), since those decisions are stored too.
+    """
+    task_categories_block, calendar_categories_block = resolve_category_blocks(task_categories, calendar_categories, prompt_context)
+    raw = "\0".join((
+        build_system_prompt(task_categories_block, calendar_categories_block),
+        os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+        fast_model_name(),
+        f"heuristics={HEURISTIC_RULES_VERSION}:{'aggressive' if aggressive_prefilter_enabled() else 'default'}",
+        f"min_content={MIN_CONTENT_CHARS}",
+    ))
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=8).hexdigest()
+
+
+# Fallback reasons caused by configuration or API trouble; these are worth retrying later
+TRANSIENT_REASON_PREFIXES = ("OpenAI library not available", "No OpenAI API key configured", "JSON parsing failed", "API error:")
+
+
+def is_transient_result(result: Dict[str, Any]) -> bool:
+    return str(result.get("reasoning", "")).startswith(TRANSIENT_REASON_PREFIXES)
+
+
+# Every classification result has exactly these keys; fallbacks override what they know
+FALLBACK_RESULT: Dict[str, Any] = {
+    "should_create": True,
+    "confidence": 0.5,
+    "title": "",
+    "notes": "",
+    "category": None,
+    "reasoning": "",
+    "meeting": None,
+}
+MEETING_REQUIRED_KEYS = ("is_meeting", "summary", "start_datetime", "end_datetime")
+
+# Below this many characters of subject + body there is nothing for the model to classify
+MIN_CONTENT_CHARS = 20
+
+
+def insufficient_content_decision(email_content: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    content_len = len(email_content["subject"]) + len(email_content["prompt_body"])
+    if content_len >= MIN_CONTENT_CHARS:
+        return None
+    logger.info("Classification skipped - Subject: '%s' | Reason: insufficient content", email_content["subject"])
+    return {
+        **FALLBACK_RESULT,
+        "should_create": False,
+        "confidence": 0.3,
+        "title": email_content["subject"] or "(empty)",
+        "reasoning": "Insufficient content",
+    }
+
+
+def build_classification(result: Dict[str, Any], email_content: Dict[str, str]) -> Dict[str, Any]:
+    """Turn one parsed model response into the classification dict callers consume."""
+    subject = email_content.get("subject", "(No subject)")
+    should_create = bool(result.get("should_create", True))
+    confidence = float(result.get("confidence", 0.5))
+    reasoning = str(result.get("reasoning", ""))[:500]
+    title = str(result.get("title", email_content["subject"]))[:200]
+    meeting_info = valid_meeting(result.get("meeting"))
+
+    classification_status = "SUCCESS" if should_create else "SKIPPED"
+    logger.info(
+        "Email classification completed - Subject: '%s' | Decision: %s | Confidence: %.2f | Reasoning: %s%s",
+        subject, classification_status, confidence, reasoning[:100], "..." if len(reasoning) > 100 else "",
+    )
+
+    if meeting_info and meeting_info.get("is_meeting"):
+        logger.info(
+            "Meeting detected in email - Subject: '%s' | Summary: '%s' | Start: %s",
+            subject, meeting_info.get("summary", "N/A"), meeting_info.get("start_datetime", "N/A"),
+        )
+
+    return {
+        "should_create": should_create,
+        "confidence": confidence,
+        "title": title,
+        "notes": str(result.get("notes", email_content["prompt_body"]))[:2000],
+        "category": result.get("category"),
+        "reasoning": reasoning,
+        "meeting": meeting_info,
+    }
+
+
+def valid_meeting(meeting_info: Any) -> Optional[Dict[str, Any]]:
+    """The meeting block if it has every key the calendar code reads, else None."""
+    if isinstance(meeting_info, dict) and all(k in meeting_info for k in MEETING_REQUIRED_KEYS):
+        return meeting_info
+    return None
 
 
 def classify_and_generate_task(
@@ -118,6 +633,7 @@ def classify_and_generate_task(
     model: str = "gpt-4o-mini",
     task_categories: list[str] | list[dict] | None = None,
     calendar_categories: list[str] | list[dict] | None = None,
+    prompt_context: Optional[Dict[str, Any]] = None,
 ) -> Dict[str, Any]:
     """
     Main function to classify email and generate task details and meetings.
@@ -126,6 +642,7 @@ def classify_and_generate_task(
         payload: Email payload containing subject, body, html, snippet, sender
         api_key: OpenAI API key (falls back to OPENAI_API_KEY env var)
         model: OpenAI model to use (default: gpt-4o-mini for cost efficiency)
+        prompt_context: Stored build_prompt_context output; skips category formatting when current
     
     Returns:
         Dictionary with:
@@ -134,283 +651,372 @@ def classify_and_generate_task(
         - title: str - generated task title
         - notes: str - generated task description/body
         - reasoning: str - explanation of classification decision
-        - title: str - generated task title
-        - notes: str - generated task description/body
-        - reasoning: str - explanation of classification decision
         - category: str | None - selected task category
         - meeting: dictoniary indicating if it should create a meeting, location, start and end time and participants.
           - category: str | None - selected calendar category
     """
-    subject = payload.get("subject", "(No subject)")
+    # Prepared first so the fallbacks below return bounded notes rather than the raw body
+    email_content = prepare_email_content(payload)
+    sender = payload.get("sender", "Unknown")
+    subject = email_content.get("subject", "(No subject)")
     
     if not OPENAI_AVAILABLE:
         logger.warning(
-            f"Classification skipped - Subject: '{subject}' | "
-            f"Reason: OpenAI library not available, using default behavior"
+            "Classification skipped - Subject: '%s' | Reason: OpenAI library not available, using default behavior",
+            subject,
         )
         return {
-            "should_create": True,
-            "confidence": 0.5,
-            "title": payload.get("subject", "Email Task"),
-            "notes": payload.get("body", payload.get("snippet", "")),
-            "reasoning": "OpenAI library not available, using default behavior"
+            **FALLBACK_RESULT,
+            "title": (subject or "Email Task")[:200],
+            "notes": email_content["prompt_body"],
+            "reasoning": "OpenAI library not available, using default behavior",
         }
     
     api_key = api_key or os.getenv("OPENAI_API_KEY")
     if not api_key:
         logger.warning(
-            f"Classification skipped - Subject: '{subject}' | "
-            f"Reason: No OpenAI API key configured, using default behavior"
+            "Classification skipped - Subject: '%s' | Reason: No OpenAI API key configured, using default behavior",
+            subject,
         )
         return {
-            "should_create": True,
-            "confidence": 0.5,
-            "title": payload.get("subject", "Email Task"),
-            "notes": payload.get("body", payload.get("snippet", "")),
-            "reasoning": "No OpenAI API key configured, using default behavior"
+            **FALLBACK_RESULT,
+            "title": (subject or "Email Task")[:200],
+            "notes": email_content["prompt_body"],
+            "reasoning": "No OpenAI API key configured, using default behavior",
         }
     
-    email_content = prepare_email_content(payload)
-    sender = payload.get("sender", "Unknown")
-    subject = email_content.get("subject", "(No subject)")
-    
-    # Normalize categories to consistent format
-    normalized_task_cats = normalize_categories(task_categories)
-    normalized_cal_cats = normalize_categories(calendar_categories)
-    
-    # Log normalized categories for debugging
-    logger.debug(
-        f"Normalized task categories: {len(normalized_task_cats)} categories "
-        f"({sum(1 for c in normalized_task_cats if c['description'])}) with descriptions"
-    )
-    logger.debug(
-        f"Normalized calendar categories: {len(normalized_cal_cats)} categories "
-        f"({sum(1 for c in normalized_cal_cats if c['description'])}) with descriptions"
-    )
-    
-    # Format categories as blocks for prompt
-    if normalized_task_cats:
-        task_categories_block = "Available Task Categories:\n" + "\n".join(
-            f"  - {cat['name']}" + (f": {cat['description']}" if cat['description'] else "")
-            for cat in normalized_task_cats
-        )
-    else:
-        task_categories_block = "Available Task Categories: None"
+    insufficient = insufficient_content_decision(email_content)
+    if insufficient is not None:
+        return insufficient
     
-    if normalized_cal_cats:
-        calendar_categories_block = "Available Calendar Categories:\n" + "\n".join(
-            f"  - {cat['name']}" + (f": {cat['description']}" if cat['description'] else "")
-            for cat in normalized_cal_cats
-        )
-    else:
-        calendar_categories_block = "Available Calendar Categories: None"
+    task_categories_block, calendar_categories_block = resolve_category_blocks(task_categories, calendar_categories, prompt_context)
     
-    logger.info(f"Processing email for classification - Subject: '{subject}', Sender: '{sender}'")
-    prompt = f"""
-You are an intelligent email assistant that helps users manage their tasks and meetings by analyzing emails.
-
-{task_categories_block}
-
-{calendar_categories_block}
-
-Instructions:
-
-1. Determine if the email represents:
-   a) a task to be created
-   b) a meeting invitation
-
-2. If it's a task:
-    - Generate a concise task title (3-8 words)
-    - Generate detailed task notes (2-4 sentences)
-    - Provide a confidence score (0.0-1.0)
-    - For the "category" field in your response: You MUST select one of the category names from the Available Task Categories list above, or null if none fit.
-      IMPORTANT: Use the exact category name as shown (the text after the "- " and before the colon, if present).
-      Do not include descriptions or any additional text - only the category name itself.
-    - Explain your reasoning
-
-
-3. If it's a meeting:
-   - Detect if it is indeed a meeting (is_meeting: true/false)
-   - Extract meeting details:
-       * summary: meeting title
-       * location: physical or virtual link (leave empty if unknown)
-        * start_datetime: RFC3339 UTC start time (leave empty if unknown)
-        * end_datetime: RFC3339 UTC end time (leave empty if unknown)
-        * participants: list of email addresses (leave empty list if unknown)
-        * category: For the meeting["category"] field in your response: You MUST select one of the category names from the Available Calendar Categories list above, or null if none fit.
-          IMPORTANT: Use the exact category name as shown (the text after the "- " and before the colon, if present).
-          Do not include descriptions or any additional text - only the category name itself.
-   - Use context clues like "meeting", "invite", "agenda", "call", "Zoom", "conference", "link"
-
-Email Details:
-From: {sender}
-Subject: {email_content['subject']}
-
-Body:
-{email_content['body'] or email_content['snippet']}
-
-Classification Guidelines:
-- CREATE TASK for emails that contain:
-  * Action items or requests
-  * Reminders or deadlines
-  * Meeting invitations requiring preparation
-  * Bills or payments due
-  * Follow-up items
-  * Tasks delegated to you
-  * Important information that needs review or response
-
-- DO NOT CREATE TASK for emails that are:
-  * Pure newsletters or marketing
-  * Automated notifications with no action needed
-  * Spam or promotional content
-  * Social media notifications
-  * Purely informational with no action required
-  * "FYI only" messages
-  * Auto-replies or out-of-office messages
-
-Respond ONLY with valid JSON in this exact format:
-{{
-  "should_create": true/false,
-  "confidence": 0.0-1.0,
-  "title": "Concise task title (3-8 words)",
-  "notes": "Detailed task description with key information",
-  "category": "Exact category name from Available Task Categories list, or null",
-  "reasoning": "Brief explanation of decision",
-  "meeting": {{
-      "is_meeting": true/false,
-      "summary": "",
-      "location": "",
-      "start_datetime": "",
-      "end_datetime": "",
-      "start_datetime": "",
-      "end_datetime": "",
-      "participants": [],
-      "category": "Exact category name from Available Calendar Categories list, or null"
-  }}
-}}
-
-CRITICAL: For both "category" fields:
-- Use the EXACT category name as listed in the Available Categories sections above
-- Do NOT include descriptions, colons, or any additional text
-- Use null if no category fits
-
-For task title:
-- Make it actionable (start with a verb if appropriate)
-- Keep it under 60 characters
-- Remove "RE:", "FWD:", etc. prefixes
-
-For task notes:
-- Include key details, dates, or requirements
-- Keep it concise but informative (2-4 sentences max)
-- Extract actionable information from the email body
-"""
+    cache_key = email_cache_key(model, task_categories_block, calendar_categories_block, email_content, sender)
+    cached = get_cached_classification(cache_key)
+    if cached is not None:
+        logger.info("Classification cache hit - Subject: '%s', Sender: '%s'", subject, sender)
+        return cached
 
+    logger.info("Processing email for classification - Subject: '%s', Sender: '%s'", subject, sender)
+    system_prompt = build_system_prompt(task_categories_block, calendar_categories_block)
 
     result: Dict[str, Any] = {}
     try:
-        client = OpenAI(api_key=api_key)
-        
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a helpful email classification assistant. Always respond with valid JSON only."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            temperature=0.3,
-            max_tokens=500,
-            response_format={"type": "json_object"}
+        response = request_completion(
+            api_key,
+            model,
+            system_prompt,
+            format_email_block(email_content, sender),
+            MAX_TOKENS_PER_EMAIL,
+            SINGLE_RESPONSE_SCHEMA,
         )
         
         result_text = response.choices[0].message.content
-        result = json.loads(result_text)
-        
-        should_create = bool(result.get("should_create", True))
-        confidence = float(result.get("confidence", 0.5))
-        reasoning = str(result.get("reasoning", ""))[:500]
-        title = str(result.get("title", email_content["subject"]))[:200]
-        meeting_info = result.get("meeting")
-        
-        classification_status = "SUCCESS" if should_create else "SKIPPED"
-        logger.info(
-            f"Email classification completed - Subject: '{subject}' | "
-            f"Decision: {classification_status} | "
-            f"Confidence: {confidence:.2f} | "
-            f"Reasoning: {reasoning[:100]}{'...' if len(reasoning) > 100 else ''}"
-        )
-        
-        if meeting_info and meeting_info.get("is_meeting"):
-            logger.info(
-                f"Meeting detected in email - Subject: '{subject}' | "
-                f"Summary: '{meeting_info.get('summary', 'N/A')}' | "
-                f"Start: {meeting_info.get('start_datetime', 'N/A')}"
-            )
+        result = json_loads(result_text)
         
-        return {
-            "should_create": should_create,
-            "confidence": confidence,
-            "title": title,
-            "notes": str(result.get("notes", email_content["body"] or email_content["snippet"]))[:2000],
-            "category": result.get("category"),
-            "reasoning": reasoning,
-            "meeting": meeting_info,
-        }
+        classification = build_classification(result, email_content)
+        cache_classification(cache_key, classification)
+        return classification
         
     except json.JSONDecodeError as e:
         logger.error(
-            f"Classification FAILED (JSON parsing error) - Subject: '{subject}' | "
-            f"Error: {str(e)} | Using fallback behavior"
+            "Classification FAILED (JSON parsing error) - Subject: '%s' | Error: %s | Using fallback behavior",
+            subject, e,
         )
         return {
-            "should_create": True,
-            "confidence": 0.5,
+            **FALLBACK_RESULT,
             "title": email_content["subject"],
-            "notes": email_content["body"] or email_content["snippet"],
-            "reasoning": "JSON parsing failed, using fallback"
+            "notes": email_content["prompt_body"],
+            "reasoning": "JSON parsing failed, using fallback",
         }
     except Exception as e:
+        fast_model = fast_model_name()
+        # Read the class from sys.modules: if the SDK failed to import, calling openai_sdk()
+        # here would raise again out of the handler, and e cannot be its RateLimitError anyway
+        rate_limit_error = getattr(sys.modules.get("openai"), "RateLimitError", ())
+        if isinstance(e, rate_limit_error) and model != fast_model:
+            logger.warning("Rate limited on %s, retrying with %s - Subject: '%s'", model, fast_model, subject)
+            return classify_and_generate_task(
+                payload,
+                api_key=api_key,
+                model=fast_model,
+                task_categories=task_categories,
+                calendar_categories=calendar_categories,
+                prompt_context=prompt_context,
+            )
         logger.error(
-            f"Classification FAILED (API error) - Subject: '{subject}' | "
-            f"Error: {str(e)} | Using fallback behavior"
+            "Classification FAILED (API error) - Subject: '%s' | Error: %s | Using fallback behavior",
+            subject, e,
         )
         return {
-            "should_create": True,
-            "confidence": 0.5,
+            **FALLBACK_RESULT,
             "title": email_content["subject"],
-            "notes": email_content["body"] or email_content["snippet"],
+            "notes": email_content["prompt_body"],
             "reasoning": f"API error: {str(e)}",
-            "meeting": result.get("meeting") if isinstance(result, dict) else None,
+            "meeting": valid_meeting(result.get("meeting")) if isinstance(result, dict) else None,
         }
 
 
+def classify_email_chunk(
+    emails: list[tuple[Dict[str, str], str]],
+    api_key: str,
+    model: str,
+    task_categories_block: str,
+    calendar_categories_block: str,
+) -> list[Optional[Dict[str, Any]]]:
+    """
+    Classify several prepared emails with a single completion.
+
+    Returns one entry per input, in order. An entry is None when the response
+    didn't contain a usable result for that email, so the caller can retry it alone.
+    """
+    system_prompt = build_system_prompt(task_categories_block, calendar_categories_block, batched=True)
+    user_prompt = f"Classify these {len(emails)} emails.\n\n" + "\n".join(
+        format_email_block(email_content, sender, index) for index, (email_content, sender) in enumerate(emails, start=1)
+    )
+
+    try:
+        response = request_completion(
+            api_key,
+            model,
+            system_prompt,
+            user_prompt,
+            MAX_TOKENS_PER_EMAIL * len(emails),
+            BATCH_RESPONSE_SCHEMA,
+        )
+        items = json_loads(response.choices[0].message.content).get("results")
+    except Exception as e:
+        logger.warning("Batch classification of %d emails failed, retrying individually: %s", len(emails), e)
+        return [None] * len(emails)
+
+    by_index: Dict[int, Dict[str, Any]] = {}
+    if isinstance(items, list):
+        for position, item in enumerate(items, start=1):
+            if isinstance(item, dict):
+                index = item.get("index", position)
+                if isinstance(index, int) and index not in by_index:
+                    by_index[index] = item
+
+    classifications: list[Optional[Dict[str, Any]]] = []
+    for index, (email_content, _sender) in enumerate(emails, start=1):
+        item = by_index.get(index)
+        try:
+            classifications.append(build_classification(item, email_content) if item is not None else None)
+        except (TypeError, ValueError):
+            classifications.append(None)
+    return classifications
+
+
+# Plain-text emails shorter than this (subject + body) go to the fast model tier
+SHORT_EMAIL_CHARS = 300
+
+
+def fast_model_name() -> str:
+    return os.getenv("OPENAI_MODEL_FAST", "gpt-4o-mini")
+
+
+def pick_model(payload: Dict[str, Any]) -> str:
+    """OPENAI_MODEL for normal emails, OPENAI_MODEL_FAST for short plain-text ones."""
+    body = payload.get("body") or payload.get("snippet") or ""
+    if not payload.get("html") and len(payload.get("subject") or "") + len(body) < SHORT_EMAIL_CHARS:
+        return fast_model_name()
+    return os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+
+
+# Signals for mail that never becomes a task; anything ambiguous is left to the model
+AUTO_REPLY_SUBJECT_RE = re.compile(r'^\s*(automatic reply|auto(matic)?[- ]?reply|out of (the )?office)\b', re.IGNORECASE)
+BULK_SENDER_RE = re.compile(r'(newsletters?|news|marketing|promo(tions)?|deals|offers)@', re.IGNORECASE)
+MARKETING_SUBJECT_RE = re.compile(r'^\s*(newsletter\b|unsubscribe\b|\[[^\]]*digest[^\]]*\])', re.IGNORECASE)
+# Broader signals, only used when OPENAI_HEURISTIC_PREFILTER=1 since they also match some bills and alerts
+NOTIFICATION_SENDER_RE = re.compile(r'(^|[<\s"])(no[-_]?reply|do[-_]?not[-_]?reply|notifications?)@', re.IGNORECASE)
+JUNK_BODY_RE = re.compile(r'\b(unsubscribe|view (it |this (email |message )?)?in (your |a )?browser)\b', re.IGNORECASE)
+# Bump when the rules above or in heuristic_decision change, so stored skips are re-classified
+HEURISTIC_RULES_VERSION = 1
+
+
+def aggressive_prefilter_enabled() -> bool:
+    return os.getenv("OPENAI_HEURISTIC_PREFILTER") == "1"
+
+
+def heuristic_decision(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Skip obvious non-tasks without calling the model.
+
+    Auto-replies are recognized from their headers or subject. Bulk mail needs a
+    List-Unsubscribe header plus a newsletter-style sender, a bulk Precedence, or a
+    newsletter/digest subject, so transactional mail (bills, reviews, invites) still
+    reaches the model. OPENAI_HEURISTIC_PREFILTER=1 additionally skips no-reply or
+    notification senders and bodies with unsubscribe/view-in-browser footers, trading
+    some missed tasks for fewer API calls. Returns None when the email should be
+    classified normally.
+    """
+    headers = payload.get("headers") or {}
+    subject = payload.get("subject") or ""
+    sender = payload.get("sender") or ""
+
+    reason = None
+    auto_submitted = headers.get("auto-submitted", "").lower()
+    if auto_submitted.startswith("auto-replied") or headers.get("x-autoreply") or headers.get("x-autorespond") or AUTO_REPLY_SUBJECT_RE.match(subject):
+        reason = "Heuristic: auto-reply"
+    elif headers.get("list-unsubscribe") and (
+        BULK_SENDER_RE.search(sender)
+        or headers.get("precedence", "").lower() in ("bulk", "junk")
+        or MARKETING_SUBJECT_RE.match(subject)
+    ):
+        reason = "Heuristic: newsletter or bulk mail"
+    elif aggressive_prefilter_enabled() and (
+        NOTIFICATION_SENDER_RE.search(sender) or JUNK_BODY_RE.search(payload.get("body") or payload.get("snippet") or "")
+    ):
+        reason = "Heuristic: notification"
+
+    if reason is None:
+        return None
+    logger.debug("%s - Subject: '%s', Sender: '%s'", reason, subject, sender)
+    return {
+        **FALLBACK_RESULT,
+        "should_create": False,
+        # The opt-in notification rule is the least certain
+        "confidence": 0.9 if reason == "Heuristic: notification" else 0.95,
+        "title": subject,
+        "reasoning": reason,
+    }
+
+
+def configured_batch_size() -> int:
+    try:
+        return max(1, int(os.getenv("OPENAI_BATCH_SIZE", ML_BATCH_SIZE)))
+    except ValueError:
+        return ML_BATCH_SIZE
+
+
+def configured_concurrency() -> int:
+    try:
+        return max(1, int(os.getenv("OPENAI_CONCURRENCY", ML_CONCURRENCY)))
+    except ValueError:
+        return ML_CONCURRENCY
+
+
 def ml_decide(
     payload: Dict[str, Any],
     task_categories: list[str] | list[dict] | None = None,
     calendar_categories: list[str] | list[dict] | None = None,
+    prompt_context: Optional[Dict[str, Any]] = None,
 ) -> Dict[str, Any]:
     """
     Main entry point for email classification.
     Uses environment variables for configuration.
     """
+    heuristic = heuristic_decision(payload)
+    if heuristic is not None:
+        return heuristic
+
     api_key = os.getenv("OPENAI_API_KEY")
-    model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
     
-    result = classify_and_generate_task(
+    return classify_and_generate_task(
         payload, 
         api_key=api_key, 
-        model=model,
+        model=pick_model(payload),
         task_categories=task_categories,
-        calendar_categories=calendar_categories
+        calendar_categories=calendar_categories,
+        prompt_context=prompt_context,
     )
-    
-    meeting_info = result.get("meeting")
-    if meeting_info:
-        required_keys = ["is_meeting", "summary", "start_datetime", "end_datetime"]
-        if not all(k in meeting_info for k in required_keys):
-            result["meeting"] = None
-    return result
+
+
+def ml_decide_batch(
+    payloads: list[Dict[str, Any]],
+    task_categories: list[str] | list[dict] | None = None,
+    calendar_categories: list[str] | list[dict] | None = None,
+    batch_size: Optional[int] = None,
+    prompt_context: Optional[Dict[str, Any]] = None,
+    concurrency: Optional[int] = None,
+) -> list[Dict[str, Any]]:
+    """
+    Classify several emails, packing up to batch_size (default OPENAI_BATCH_SIZE) of them into each OpenAI request.
+
+    Up to concurrency (default OPENAI_CONCURRENCY) requests are in flight at once.
+    Results are returned in input order. Cached emails are not resent, identical
+    emails are sent once, and any email a batched response doesn't cover falls
+    back to ml_decide on its own.
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    batch_size = batch_size or configured_batch_size()
+    concurrency = concurrency or configured_concurrency()
+    results: list[Optional[Dict[str, Any]]] = [heuristic_decision(payload) for payload in payloads]
+    # Identical emails in one sync (notification bursts) are classified once and copied
+    duplicate_of: Dict[int, int] = {}
+
+    if OPENAI_AVAILABLE and api_key and results.count(None) > 1:
+        task_categories_block, calendar_categories_block = resolve_category_blocks(
+            task_categories, calendar_categories, prompt_context
+        )
+
+        pending: Dict[str, list] = {}
+        first_position: Dict[str, int] = {}
+        for position, payload in enumerate(payloads):
+            if results[position] is not None:
+                continue
+            email_content = prepare_email_content(payload)
+            insufficient = insufficient_content_decision(email_content)
+            if insufficient is not None:
+                results[position] = insufficient
+                continue
+            sender = payload.get("sender", "Unknown")
+            model = pick_model(payload)
+            cache_key = email_cache_key(model, task_categories_block, calendar_categories_block, email_content, sender)
+            cached = get_cached_classification(cache_key)
+            if cached is not None:
+                results[position] = cached
+            elif cache_key in first_position:
+                duplicate_of[position] = first_position[cache_key]
+            else:
+                first_position[cache_key] = position
+                pending.setdefault(model, []).append((position, email_content, sender, cache_key))
+
+        # A batch goes to a single model, so emails are chunked per model tier
+        chunks = [
+            (model, entries[start:start + batch_size])
+            for model, entries in pending.items()
+            for start in range(0, len(entries), batch_size)
+        ]
+        chunks = [(model, chunk) for model, chunk in chunks if len(chunk) > 1]
+
+        def classify(model_and_chunk):
+            model, chunk = model_and_chunk
+            logger.info("Classifying %d emails in one request with %s", len(chunk), model)
+            return classify_email_chunk(
+                [(email_content, sender) for _, email_content, sender, _ in chunk],
+                api_key,
+                model,
+                task_categories_block,
+                calendar_categories_block,
+            )
+
+        if chunks:
+            # Completions are network-bound, so overlap them; the shared client is thread-safe
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks))) as executor:
+                for (_, chunk), classifications in zip(chunks, executor.map(classify, chunks)):
+                    for (position, _, _, cache_key), classification in zip(chunk, classifications):
+                        if classification is not None:
+                            cache_classification(cache_key, classification)
+                            results[position] = classification
+
+    # Whatever is left (no API key, single payloads, emails a batch missed) is classified one by one
+    leftover = [position for position, result in enumerate(results) if result is None and position not in duplicate_of]
+    if leftover:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(leftover))) as executor:
+            decisions = executor.map(
+                lambda position: ml_decide(
+                    payloads[position],
+                    task_categories=task_categories,
+                    calendar_categories=calendar_categories,
+                    prompt_context=prompt_context,
+                ),
+                leftover,
+            )
+            for position, decision in zip(leftover, decisions):
+                results[position] = decision
+
+    for position, original in duplicate_of.items():
+        results[position] = copy.deepcopy(results[original])
+
+    return results
@@ -21,7 +21,7 @@ def _truncate(s: str, limit: int = MAX_NOTES_LEN) -> str:
     return f"{head}\n...\n{tail}"
 
 
-def _get_or_create_tasklist(service: Resource, title: str) -> str:
+def get_or_create_tasklist(service: Resource, title: str) -> str:
     """Return tasklist id with given title. create it if missing."""
     try:
         req = service.tasklists().list(maxResults=100)
@@ -71,7 +71,7 @@ def create_task(
 
     try:
         if not tasklist_id:
-            list_id = _get_or_create_tasklist(tasks_service, tasklist_title or "Tasks")
+            list_id = get_or_create_tasklist(tasks_service, tasklist_title or "Tasks")
         else:
             list_id = tasklist_id
 
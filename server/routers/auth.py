@@ -1,8 +1,8 @@
-from flask import Blueprint, session, jsonify, redirect, request
+from flask import Blueprint, current_app, session, jsonify, redirect, request
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
+from requests.adapters import HTTPAdapter
 from server.config import CLIENT_SECRETS_CONFIG, REDIRECT_URI, FRONTEND_URL
-from server.utils import SCOPES, get_or_create_user, encode_jwt
+from server.utils import SCOPES, build_service, decode_jwt, get_jwt_from_request, get_or_create_user, encode_jwt, require_auth
 from server.db import db_session
 import os
 import logging
@@ -11,39 +11,47 @@ logger = logging.getLogger(__name__)
 
 auth_bp = Blueprint('auth', __name__)
 
+# Every Flow gets a fresh requests session; mounting one adapter on all of them lets
+# token exchanges reuse the pooled keep-alive connections to Google's token endpoint
+_oauth_adapter = HTTPAdapter(pool_maxsize=8)
+
+# Polled by the frontend; the bodies never change, so skip the JSON encoder entirely
+AUTH_STATUS_BODIES = {True: b'{"authenticated":true}', False: b'{"authenticated":false}'}
+
+def _auth_status_response(authenticated: bool):
+    response = current_app.response_class(AUTH_STATUS_BODIES[authenticated], mimetype="application/json")
+    # The answer depends only on the bearer token, so a short private cache keyed on it is safe
+    response.headers["Cache-Control"] = "private, max-age=5"
+    response.vary.add("Authorization")
+    return response
+
 def _create_flow():
     """Create OAuth flow from config dict (from environment variable)."""
-    return Flow.from_client_config(
+    flow = Flow.from_client_config(
         CLIENT_SECRETS_CONFIG,
         scopes=SCOPES,
         redirect_uri=REDIRECT_URI,
     )
+    flow.oauth2session.mount("https://", _oauth_adapter)
+    return flow
 
 @auth_bp.route("/auth/status")
 def auth_status():
-    from server.utils import get_jwt_from_request, decode_jwt
+    # Answers unauthenticated callers with 200 rather than require_auth's 401
     token = get_jwt_from_request()
     if not token:
-        return jsonify({"authenticated": False})
+        return _auth_status_response(False)
     
     payload = decode_jwt(token)
     if not payload:
-        return jsonify({"authenticated": False})
+        return _auth_status_response(False)
     
-    return jsonify({"authenticated": True})
+    return _auth_status_response(True)
 
 @auth_bp.route("/user")
+@require_auth
 def user_info():
-    from server.utils import get_jwt_from_request, decode_jwt
-    token = get_jwt_from_request()
-    if not token:
-        return jsonify({"error": "Not authenticated"}), 401
-    
-    payload = decode_jwt(token)
-    if not payload:
-        return jsonify({"error": "Invalid or expired token"}), 401
-    
-    return jsonify({"authenticated": True})
+    return _auth_status_response(True)
 
 @auth_bp.route("/authorize")
 def authorize():
@@ -70,9 +78,10 @@ def oauth2callback():
                 auth_response_url += '?' + request.query_string.decode('utf-8')
         else:
             auth_response_url = request.url
-            os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
         flow.fetch_token(authorization_response=auth_response_url)
         credentials = flow.credentials
+        # Kept in the session cookie only if they can't be stored on the user row below;
+        # the cookie is sent with every request, so it shouldn't carry them otherwise
         session["credentials"] = {
             "token": credentials.token,
             "refresh_token": credentials.refresh_token,
@@ -82,7 +91,7 @@ def oauth2callback():
             "scopes": credentials.scopes,
         }
         # Get and create user in database
-        gmail_service = build("gmail", "v1", credentials=credentials)
+        gmail_service = build_service("gmail", "v1", credentials)
         try:
             profile = gmail_service.users().getProfile(userId="me").execute()
             user_email = profile.get("emailAddress")
@@ -98,19 +107,25 @@ def oauth2callback():
                     user.google_client_id = credentials.client_id
                     user.google_client_secret = credentials.client_secret
                     user.google_scopes = credentials.scopes
+                    user.google_token_expiry = credentials.expiry
+                # server.utils.get_credentials reads them from the user row from now on
+                session.pop("credentials", None)
                     
-                logger.info(f"User authenticated: {user_email}")
+                logger.info("User authenticated: %s", user_email)
                 
                 # Generate JWT token
                 jwt_token = encode_jwt(user_email)
                 session["jwt_token"] = jwt_token
         except Exception as e:
-            logger.error(f"Error getting user profile: {e}")
+            logger.error("Error getting user profile: %s", e)
         # Mark session as modified to ensure it's saved
         session.modified = True
         frontend_url = os.getenv("FRONTEND_URL", FRONTEND_URL)
-        logger.info(f"Redirecting to frontend: {frontend_url}")
-        logger.info(f"Session after auth - has credentials: {'credentials' in session}, has user_email: {'user_email' in session}")
+        logger.info("Redirecting to frontend: %s", frontend_url)
+        logger.info(
+            "Session after auth - has credentials: %s, has user_email: %s",
+            "credentials" in session, "user_email" in session,
+        )
         
         # Redirect with JWT token as query parameter for frontend to pick up
         jwt_token = session.get("jwt_token", "")
@@ -119,7 +134,7 @@ def oauth2callback():
             redirect_url = f"{frontend_url}/?token={jwt_token}"
         
         response = redirect(redirect_url)
-        logger.info(f"Response headers - Set-Cookie present: {'Set-Cookie' in str(response.headers)}")
+        logger.info("Response headers - Set-Cookie present: %s", "Set-Cookie" in response.headers)
         return response
     except Exception as e:
         raise
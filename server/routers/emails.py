@@ -3,16 +3,32 @@ from datetime import datetime, timezone, timedelta
 from dateutil import parser as dateutil_parser
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import logging
-from server.utils import get_gmail_service, get_current_user, message_to_payload, require_auth
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from server.utils import build_service, get_gmail_service, get_current_user, message_to_payload, require_auth
 from server.config import DEFAULT_PROVIDER, TASKS_LIST_TITLE
 from server.db import db_session, Email, Task, CalendarEvent, UserSettings
-from server.ml import ml_decide, normalize_categories
-from server.providers.google_tasks import create_task as create_google_task, GoogleTasksError
+from server.ml import build_prompt_context, classification_version, is_current_prompt_context, is_transient_result, ml_decide_batch
+from server.providers.google_tasks import create_task as create_google_task, get_or_create_tasklist, GoogleTasksError
+from googleapiclient.errors import HttpError
 from sqlalchemy import select
 
 emails_bp = Blueprint('emails', __name__)
 logger = logging.getLogger(__name__)
 
+# Gmail rejects batch requests with more than 100 calls
+GMAIL_BATCH_LIMIT = 100
+# Largest page messages.list will return
+GMAIL_LIST_PAGE_LIMIT = 500
+# Parts of a full message that message_to_payload reads (historyId keys its cache)
+GMAIL_MESSAGE_FIELDS = "id,threadId,historyId,internalDate,snippet,payload"
+# Concurrent Google Tasks inserts per fetch request
+DISPATCH_WORKERS = 8
+# Individual fetches for messages the batch endpoint rejected; kept low since Gmail limits per-user concurrency
+GMAIL_FALLBACK_WORKERS = 4
+GMAIL_RETRY_ATTEMPTS = 3
+GMAIL_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
 def resolve_client_timezone(timezone_name: str | None):
     if not timezone_name:
         return timezone.utc
@@ -88,8 +104,8 @@ def gmail_list_ids(service, q: str, max_list: int | None = 50, min_internal_ms:
     page_token = None
     page_num = 0
 
-    # Page size is capped by Gmail at 100 anyway
-    page_size = 100 if max_list is None else min(100, max_list if max_list > 0 else 100)
+    # Gmail allows up to 500 ids per page, so one page usually covers the requested max
+    page_size = GMAIL_LIST_PAGE_LIMIT if max_list is None else min(GMAIL_LIST_PAGE_LIMIT, max_list if max_list > 0 else GMAIL_LIST_PAGE_LIMIT)
 
     while True:
         page_num += 1
@@ -97,7 +113,13 @@ def gmail_list_ids(service, q: str, max_list: int | None = 50, min_internal_ms:
             resp = (
                 service.users()
                 .messages()
-                .list(userId="me", q=q, maxResults=page_size, pageToken=page_token)
+                .list(
+                    userId="me",
+                    q=q,
+                    maxResults=page_size,
+                    pageToken=page_token,
+                    fields="messages/id,nextPageToken",
+                )
                 .execute()
             )
             messages = resp.get("messages", [])
@@ -107,17 +129,16 @@ def gmail_list_ids(service, q: str, max_list: int | None = 50, min_internal_ms:
         if min_internal_ms is None:
             ids.extend(m["id"] for m in messages)
         else:
-            # metadata call to read internalDate for precise cutoff
-            for m in messages:
-                meta = (
-                    service.users()
-                    .messages()
-                    .get(userId="me", id=m["id"], format="metadata", metadataHeaders=[])
-                    .execute()
-                )
-                internal_ms = int(meta.get("internalDate", 0))
+            # batched minimal fetch of just internalDate for the precise cutoff
+            page_ids = [m["id"] for m in messages]
+            metas = gmail_get_messages(service, page_ids, format="minimal", fields="id,internalDate")
+            for message_id in page_ids:
+                meta, error = metas.get(message_id, (None, None))
+                if error is not None:
+                    raise error
+                internal_ms = int((meta or {}).get("internalDate", 0))
                 if internal_ms >= min_internal_ms:
-                    ids.append(m["id"])
+                    ids.append(message_id)
 
         # Stop if we reached requested max
         if max_list is not None and len(ids) >= max_list:
@@ -129,8 +150,98 @@ def gmail_list_ids(service, q: str, max_list: int | None = 50, min_internal_ms:
 
     return ids
 
-def get_or_create_email(session, user_id: int, message_id: str, meta: dict | None = None) -> Email:
-    e = session.query(Email).filter_by(user_id=user_id, gmail_message_id=message_id).one_or_none()
+def gmail_batch_get(service, ids: list[str], format: str = "full", **params) -> dict[str, tuple[dict | None, Exception | None]]:
+    """
+    Fetch many messages through Gmail batch requests instead of one HTTP call per id.
+    Extra params (e.g. fields) are passed to every messages().get() call.
+    Returns {message_id: (message, exception)}; each batch holds at most GMAIL_BATCH_LIMIT calls.
+    """
+    results: dict[str, tuple[dict | None, Exception | None]] = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    for start in range(0, len(ids), GMAIL_BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=callback)
+        for message_id in ids[start:start + GMAIL_BATCH_LIMIT]:
+            batch.add(
+                service.users().messages().get(userId="me", id=message_id, format=format, **params),
+                request_id=message_id,
+            )
+        batch.execute()
+
+    return results
+
+def is_retryable_gmail_error(error: Exception | None) -> bool:
+    return isinstance(error, HttpError) and error.resp.status in GMAIL_RETRYABLE_STATUSES
+
+def gmail_fetch_concurrently(ids: list[str], format: str = "full", **params) -> dict[str, tuple[dict | None, Exception | None]]:
+    """
+    Fetch messages with individual concurrent requests, retrying rate limits and server errors with backoff.
+    Used for ids the batch endpoint rejected; each worker thread builds its own Gmail client.
+    """
+    from server.utils import get_credentials
+    creds = get_credentials()
+    local = threading.local()
+
+    def fetch(message_id: str) -> tuple[dict | None, Exception | None]:
+        if not hasattr(local, "service"):
+            local.service = build_service("gmail", "v1", creds)
+        try:
+            call = local.service.users().messages().get(userId="me", id=message_id, format=format, **params)
+            return call.execute(num_retries=GMAIL_RETRY_ATTEMPTS), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=min(GMAIL_FALLBACK_WORKERS, len(ids))) as executor:
+        return dict(zip(ids, executor.map(fetch, ids)))
+
+def gmail_get_messages(service, ids: list[str], format: str = "full", **params) -> dict[str, tuple[dict | None, Exception | None]]:
+    """
+    Batch-fetch messages, falling back to concurrent single requests for anything
+    the batch rejected with a retryable error (or for everything if the batch call itself failed).
+    """
+    try:
+        results = gmail_batch_get(service, ids, format=format, **params)
+    except HttpError as e:
+        if not is_retryable_gmail_error(e):
+            raise
+        logger.warning(f"Gmail batch request failed ({e.resp.status}), fetching {len(ids)} message(s) individually")
+        results = {}
+
+    failed = [message_id for message_id in ids if message_id not in results or is_retryable_gmail_error(results[message_id][1])]
+    if failed:
+        logger.info(f"Retrying {len(failed)} Gmail message fetch(es) outside the batch")
+        results.update(gmail_fetch_concurrently(failed, format=format, **params))
+    return results
+
+def load_known_emails(session, user_id: int, message_ids: list[str], provider: str) -> tuple[dict[str, Email], set[str]]:
+    """
+    Look up stored emails for a batch of Gmail ids in two queries instead of two per message.
+    Returns ({gmail_message_id: Email}, {gmail_message_id already having a task for provider}).
+    """
+    if not message_ids:
+        return {}, set()
+    emails = session.execute(
+        select(Email).where(Email.user_id == user_id).where(Email.gmail_message_id.in_(message_ids))
+    ).scalars().all()
+    known = {e.gmail_message_id: e for e in emails}
+    if not known:
+        return known, set()
+    ids_by_pk = {e.id: e.gmail_message_id for e in emails}
+    tasked = session.execute(
+        select(Task.email_id)
+        .where(Task.user_id == user_id)
+        .where(Task.provider == provider)
+        .where(Task.email_id.in_(list(ids_by_pk)))
+    ).scalars().all()
+    return known, {ids_by_pk[email_id] for email_id in tasked}
+
+def get_or_create_email(session, user_id: int, message_id: str, meta: dict | None = None, known: dict[str, Email] | None = None) -> Email:
+    if known is not None:
+        e = known.get(message_id)
+    else:
+        e = session.query(Email).filter_by(user_id=user_id, gmail_message_id=message_id).one_or_none()
     if e:
         return e
     e = Email(
@@ -150,18 +261,48 @@ def get_or_create_email(session, user_id: int, message_id: str, meta: dict | Non
     session.flush()
     return e
 
-def task_exists(session, user_id: int, email_id: int, provider: str) -> bool:
-    return session.query(Task.id).filter_by(user_id=user_id, email_id=email_id, provider=provider).first() is not None
+def mark_email_processed(email_row: Email) -> None:
+    now = datetime.now(timezone.utc)
+    if not email_row.first_processed_at:
+        email_row.first_processed_at = now
+    email_row.last_processed_at = now
+    email_row.processed = True
 
-def dispatch_task(provider: str, payload: dict) -> dict:
-    from server.utils import get_tasks_service
-    if provider == "google_tasks":
-        tasks_service = get_tasks_service()
-        if not tasks_service:
-            raise GoogleTasksError("Not authenticated for Google Tasks")
-        return create_google_task(tasks_service, TASKS_LIST_TITLE, payload)
+def dispatch_tasks(provider: str, payloads: list[dict]) -> list[tuple[dict | None, Exception | None]]:
+    """
+    Create tasks for many payloads concurrently.
+    Google API clients are not thread-safe, so every worker thread builds its own
+    service from the request's credentials. Returns (task, error) per payload, in order.
+    """
+    if not payloads:
+        return []
+    if provider != "google_tasks":
+        error = ValueError(f"Unsupported provider '{provider}'")
+        return [(None, error) for _ in payloads]
+
+    from server.utils import get_credentials
+    creds = get_credentials()
+    if not creds:
+        error = GoogleTasksError("Not authenticated for Google Tasks")
+        return [(None, error) for _ in payloads]
+
+    try:
+        tasklist_id = get_or_create_tasklist(build_service("tasks", "v1", creds), TASKS_LIST_TITLE)
+    except GoogleTasksError as e:
+        return [(None, e) for _ in payloads]
+
+    local = threading.local()
+
+    def create(payload: dict) -> tuple[dict | None, Exception | None]:
+        if not hasattr(local, "service"):
+            local.service = build_service("tasks", "v1", creds)
+        try:
+            return create_google_task(local.service, TASKS_LIST_TITLE, payload, tasklist_id=tasklist_id), None
+        except Exception as e:
+            return None, e
 
-    raise ValueError(f"Unsupported provider '{provider}'")
+    with ThreadPoolExecutor(max_workers=min(DISPATCH_WORKERS, len(payloads))) as executor:
+        return list(executor.map(create, payloads))
 
 def create_google_calendar_event(meeting: dict, client_timezone: str | None):
     """
@@ -278,32 +419,44 @@ def fetch_emails():
 
     created_tasks = []
     created_calendar_events = []
-    already_processed_count = 0
-    considered = 0
+    to_dispatch = []
 
     # Get auto_generate setting and categories
     with db_session() as s:
         stmt = select(UserSettings).where(UserSettings.user_id == user.id)
         user_settings = s.execute(stmt).scalar_one_or_none()
         auto_generate = user_settings.auto_generate if user_settings and user_settings.auto_generate is not None else True
-        # Normalize categories to ensure we pass full {name, description} objects to ml_decide
-        # This handles backward compatibility with old string format in database
-        task_categories_raw = user_settings.task_categories if user_settings else []
-        calendar_categories_raw = user_settings.calendar_categories if user_settings else []
-        task_categories = normalize_categories(task_categories_raw)
-        calendar_categories = normalize_categories(calendar_categories_raw)
+        # server.ml accepts both the old string format and {name, description} objects, and only
+        # normalizes when its memoized category blocks miss, so the stored lists are passed as-is
+        task_categories = user_settings.task_categories if user_settings else []
+        calendar_categories = user_settings.calendar_categories if user_settings else []
+        # Category prompt blocks are stored on save; backfill settings saved before that existed
+        prompt_context = user_settings.prompt_context if user_settings else None
+        if user_settings and not is_current_prompt_context(prompt_context):
+            prompt_context = build_prompt_context(task_categories, calendar_categories)
+            user_settings.prompt_context = prompt_context
 
     logger.info(f"Auto-generate setting: {auto_generate}")
 
     with db_session() as s:
-        for message_id in ids:
+        # Dedupe per provider up front so already-tasked emails are neither fetched nor classified
+        known_emails, processed_ids = load_known_emails(s, user.id, ids, provider)
+        pending_ids = [message_id for message_id in ids if message_id not in processed_ids]
+        already_processed_count = len(ids) - len(pending_ids)
+        considered = already_processed_count
+        if already_processed_count:
+            logger.info(f"Skipping {already_processed_count} already processed email(s) for provider {provider}")
+
+        messages = gmail_get_messages(service, pending_ids, format="full", fields=GMAIL_MESSAGE_FIELDS)
+
+        prepared = []
+        for message_id in pending_ids:
             considered += 1
-            full_msg = (
-                service.users()
-                .messages()
-                .get(userId="me", id=message_id, format="full")
-                .execute()
-            )
+            full_msg, fetch_error = messages.get(message_id, (None, None))
+            if fetch_error is not None:
+                raise fetch_error
+            if full_msg is None:
+                continue
 
             # precise guard if since_dt provided
             if since_dt:
@@ -311,7 +464,34 @@ def fetch_emails():
                 if internal_ms < int(since_dt.timestamp() * 1000):
                     continue
 
-            payload = message_to_payload(full_msg)
+            prepared.append((message_id, message_to_payload(full_msg)))
+
+        # Gmail messages never change, so a classification stored by an earlier sync under the
+        # same prompt and models is reused; skipped emails are re-fetched on every sync otherwise
+        ml_version = classification_version(task_categories, calendar_categories, prompt_context)
+        ml_results = {}
+        for message_id, _ in prepared:
+            known = known_emails.get(message_id)
+            if known is not None and known.ml_result and known.ml_version == ml_version:
+                ml_results[message_id] = known.ml_result
+        stored_count = len(ml_results)
+        if stored_count:
+            logger.info(f"Reusing {stored_count} stored classification(s)")
+
+        # ML Classification and Task Generation, several emails per OpenAI request
+        unclassified = [(message_id, payload) for message_id, payload in prepared if message_id not in ml_results]
+        ml_results.update(zip(
+            [message_id for message_id, _ in unclassified],
+            ml_decide_batch(
+                [payload for _, payload in unclassified],
+                task_categories=task_categories,
+                calendar_categories=calendar_categories,
+                prompt_context=prompt_context,
+            ),
+        ))
+
+        for message_id, payload in prepared:
+            ml_result = ml_results[message_id]
             subject = payload.get("subject", "(No subject)")
             sender = payload.get("sender", "Unknown")
             message_id_short = message_id[:20] + "..." if len(message_id) > 20 else message_id
@@ -324,8 +504,6 @@ def fetch_emails():
                 f"Received: {payload.get('received_at', 'N/A')}"
             )
 
-            # ML Classification and Task Generation
-            ml_result = ml_decide(payload, task_categories=task_categories, calendar_categories=calendar_categories)
             should_create = ml_result.get("should_create", True)
             confidence = ml_result.get("confidence", 0.5)
             reasoning = ml_result.get("reasoning", "")
@@ -339,7 +517,10 @@ def fetch_emails():
             )
 
             # Store email with ML metadata
-            email_row = get_or_create_email(s, user.id, message_id, payload)
+            email_row = get_or_create_email(s, user.id, message_id, payload, known=known_emails)
+            if email_row.ml_version != ml_version and not is_transient_result(ml_result):
+                email_row.ml_result = ml_result
+                email_row.ml_version = ml_version
             
             #create meeting if necessary
             meeting_info = ml_result.get("meeting")
@@ -481,10 +662,7 @@ def fetch_emails():
                     f"Reasoning: {reasoning[:100]}{'...' if len(reasoning) > 100 else ''}"
                 )
                 # Mark as processed but don't create task
-                if not email_row.first_processed_at:
-                    email_row.first_processed_at = datetime.now(timezone.utc)
-                email_row.last_processed_at = datetime.now(timezone.utc)
-                email_row.processed = True
+                mark_email_processed(email_row)
                 continue
 
             # Use ML-generated title and notes
@@ -498,57 +676,18 @@ def fetch_emails():
             if due:
                 payload["due"] = due
 
-            # Dedupe per provider
-            if task_exists(s, user.id, email_row.id, provider):
-                logger.info(
-                    f"Email already processed - ID: {message_id_short} | "
-                    f"Subject: '{subject}' | "
-                    f"Provider: {provider}"
-                )
-                already_processed_count += 1
-                continue
-
             if auto_generate:
-                # Create task in Google Tasks immediately
-                try:
-                    task = dispatch_task(provider, payload)
-                    task_id = task.get("id") if isinstance(task, dict) else None
-                    task_title = task.get("title") if isinstance(task, dict) else subject
-                    
-                    logger.info(
-                        f"Task created successfully - Email ID: {message_id_short} | "
-                        f"Subject: '{subject}' | "
-                        f"Task ID: {task_id} | "
-                        f"Task Title: '{task_title}' | "
-                        f"Provider: {provider} | "
-                        f"Confidence: {confidence:.2f}"
-                    )
-                    
-                    # Record task in DB with created status
-                    t = Task(
-                        user_id=user.id,
-                        email_id=email_row.id,
-                        provider=provider,
-                        provider_task_id=(task.get("id") if isinstance(task, dict) else None),
-                        provider_metadata=task if isinstance(task, dict) else None,
-                        status="created",
-                        category=category_from_request or ml_result.get("category"),
-                    )
-                    s.add(t)
-                    
-                    created_tasks.append({
-                        "message_id": message_id,
-                        "provider": provider,
-                        "task": task,
-                    })
-                except Exception as err:
-                    logger.error(
-                        f"Task creation FAILED - Email ID: {message_id_short} | "
-                        f"Subject: '{subject}' | "
-                        f"Provider: {provider} | "
-                        f"Error: {str(err)}"
-                    )
-                    return jsonify({"error": f"Error creating task: {str(err)}"}), 400
+                # Queue for concurrent creation in Google Tasks once all emails are classified
+                to_dispatch.append({
+                    "message_id": message_id,
+                    "message_id_short": message_id_short,
+                    "email_row": email_row,
+                    "payload": payload,
+                    "subject": subject,
+                    "confidence": confidence,
+                    "category": category_from_request or ml_result.get("category"),
+                })
+                continue
             else:
                 # Create pending task (don't create in Google Tasks yet)
                 logger.info(
@@ -563,7 +702,8 @@ def fetch_emails():
                     "title": subject,
                     "notes": notes,
                     "due": due,
-                    "payload": payload,  # Store full payload for later creation
+                    # Store the payload for later creation, minus the raw HTML that task creation never reads
+                    "payload": {k: v for k, v in payload.items() if k not in ("html", "html_converted")},
                 }
                 
                 t = Task(
@@ -587,11 +727,58 @@ def fetch_emails():
                 })
 
             # Mark email processed
-            now = datetime.now(timezone.utc)
-            if not email_row.first_processed_at:
-                email_row.first_processed_at = now
-            email_row.last_processed_at = now
-            email_row.processed = True
+            mark_email_processed(email_row)
+
+        # Create the queued tasks concurrently, then record results in input order
+        first_error = None
+        dispatch_results = dispatch_tasks(provider, [item["payload"] for item in to_dispatch])
+        for item, (task, err) in zip(to_dispatch, dispatch_results):
+            message_id_short = item["message_id_short"]
+            subject = item["subject"]
+            if err is not None:
+                logger.error(
+                    f"Task creation FAILED - Email ID: {message_id_short} | "
+                    f"Subject: '{subject}' | "
+                    f"Provider: {provider} | "
+                    f"Error: {str(err)}"
+                )
+                if first_error is None:
+                    first_error = err
+                continue
+
+            task_id = task.get("id") if isinstance(task, dict) else None
+            task_title = task.get("title") if isinstance(task, dict) else subject
+            logger.info(
+                f"Task created successfully - Email ID: {message_id_short} | "
+                f"Subject: '{subject}' | "
+                f"Task ID: {task_id} | "
+                f"Task Title: '{task_title}' | "
+                f"Provider: {provider} | "
+                f"Confidence: {item['confidence']:.2f}"
+            )
+
+            # Record task in DB with created status
+            t = Task(
+                user_id=user.id,
+                email_id=item["email_row"].id,
+                provider=provider,
+                provider_task_id=task_id,
+                provider_metadata=task if isinstance(task, dict) else None,
+                status="created",
+                category=item["category"],
+            )
+            s.add(t)
+
+            created_tasks.append({
+                "message_id": item["message_id"],
+                "provider": provider,
+                "task": task,
+            })
+            mark_email_processed(item["email_row"])
+
+        if first_error is not None:
+            # Tasks that were created before the failure stay recorded
+            return jsonify({"error": f"Error creating task: {str(first_error)}"}), 400
 
     result = {
         "processed": len(created_tasks),
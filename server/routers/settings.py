@@ -2,7 +2,9 @@ from flask import Blueprint, session, jsonify, request
 from datetime import datetime, timezone
 from server.utils import get_current_user, require_auth
 from server.db import db_session, UserSettings
+from server.ml import build_prompt_context
 from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 settings_bp = Blueprint('settings', __name__)
 
@@ -20,6 +22,10 @@ def extract_category_names(raw: list[str] | list[dict] | None) -> list[str]:
     if not raw:
         return []
     
+    # Fast path: settings are stored, and usually sent, as plain lists of names
+    if all(type(item) is str for item in raw):
+        return [name for name in (item.strip() for item in raw) if name]
+    
     names = []
     for item in raw:
         if isinstance(item, str):
@@ -34,6 +40,13 @@ def extract_category_names(raw: list[str] | list[dict] | None) -> list[str]:
     
     return names
 
+def conditional_json(result: dict):
+    """JSON response with a content ETag; a matching If-None-Match gets an empty 304 instead."""
+    response = jsonify(result)
+    response.add_etag()
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
+
 @settings_bp.route("/settings", methods=["GET"])
 @require_auth
 def get_settings():
@@ -52,26 +65,28 @@ def get_settings():
             
             if not user_settings:
                 # Return default settings if none exist
-                return jsonify({
+                result = {
                     "max": 10,
                     "window": "1d",
                     "task_categories": [],
                     "calendar_categories": [],
                     "auto_generate": True,
-                })
-            
-            # Extract category names (handles backward compatibility with old string format)
-            # If stored as objects, extract just the names; if stored as strings, use as-is
-            task_cats = extract_category_names(user_settings.task_categories)
-            cal_cats = extract_category_names(user_settings.calendar_categories)
-            
-            return jsonify({
-                "max": user_settings.max,
-                "window": user_settings.window,
-                "task_categories": task_cats,
-                "calendar_categories": cal_cats,
-                "auto_generate": user_settings.auto_generate if user_settings.auto_generate is not None else True,
-            })
+                }
+            else:
+                # Extract category names (handles backward compatibility with old string format)
+                # If stored as objects, extract just the names; if stored as strings, use as-is
+                task_cats = extract_category_names(user_settings.task_categories)
+                cal_cats = extract_category_names(user_settings.calendar_categories)
+                
+                result = {
+                    "max": user_settings.max,
+                    "window": user_settings.window,
+                    "task_categories": task_cats,
+                    "calendar_categories": cal_cats,
+                    "auto_generate": user_settings.auto_generate if user_settings.auto_generate is not None else True,
+                }
+
+        return conditional_json(result)
     except Exception as e:
         return jsonify({"error": "Failed to fetch settings"}), 500
 
@@ -103,44 +118,36 @@ def update_settings():
         # Result: ["Work", "Personal"] (array of strings)
         task_categories_normalized = extract_category_names(task_categories_raw) if task_categories_raw is not None else []
         calendar_categories_normalized = extract_category_names(calendar_categories_raw) if calendar_categories_raw is not None else []
-
+        # Format the prompt's category blocks now, so email syncs don't redo it per request
+        prompt_context = build_prompt_context(task_categories_normalized, calendar_categories_normalized)
+
+        values = {
+            "provider": "google_tasks",
+            "max": max_value,
+            "window": window,
+            "task_categories": task_categories_normalized,
+            "calendar_categories": calendar_categories_normalized,
+            "prompt_context": prompt_context,
+            "auto_generate": auto_generate if auto_generate is not None else True,
+            "updated_at": datetime.now(timezone.utc),
+        }
+        # Create or update in one statement instead of a SELECT followed by an INSERT or UPDATE
+        stmt = (
+            sqlite_insert(UserSettings)
+            .values(user_id=user_id, **values)
+            .on_conflict_do_update(index_elements=[UserSettings.user_id], set_=values)
+        )
         with db_session() as s:
-            stmt = select(UserSettings).where(UserSettings.user_id == user_id)
-            user_settings = s.execute(stmt).scalar_one_or_none()
-
-            if user_settings:
-                # Update existing settings
-                user_settings.provider = "google_tasks"
-                user_settings.max = max_value
-                user_settings.window = window
-                user_settings.task_categories = task_categories_normalized
-                user_settings.calendar_categories = calendar_categories_normalized
-                user_settings.auto_generate = auto_generate if auto_generate is not None else True
-                user_settings.updated_at = datetime.now(timezone.utc)
-            else:
-                # Create new settings
-                user_settings = UserSettings(
-                    user_id=user_id,
-                    provider="google_tasks",
-                    max=max_value,
-                    window=window,
-                    task_categories=task_categories_normalized,
-                    calendar_categories=calendar_categories_normalized,
-                    auto_generate=auto_generate if auto_generate is not None else True,
-                )
-                s.add(user_settings)
-            
-            s.flush()
-            
-            # Extract values before session closes
-            # Extract names again to ensure consistent format (defensive programming)
-            result = {
-                "max": user_settings.max,
-                "window": user_settings.window,
-                "task_categories": extract_category_names(user_settings.task_categories),
-                "calendar_categories": extract_category_names(user_settings.calendar_categories),
-                "auto_generate": user_settings.auto_generate if user_settings.auto_generate is not None else True,
-            }
+            s.execute(stmt)
+
+        # Every stored field came from this request, so the response needs no read-back
+        result = {
+            "max": values["max"],
+            "window": values["window"],
+            "task_categories": task_categories_normalized,
+            "calendar_categories": calendar_categories_normalized,
+            "auto_generate": values["auto_generate"],
+        }
 
         return jsonify(result)
     except Exception as e:
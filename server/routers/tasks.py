@@ -1,9 +1,11 @@
-from flask import Blueprint, session, jsonify, request
+from flask import Blueprint, current_app, session, jsonify, request
+from datetime import datetime, timezone
+import hashlib
 from server.utils import get_current_user, get_tasks_service, require_auth
 from server.db import db_session, Task, Email
 from server.providers.google_tasks import delete_task as delete_google_task, create_task as create_google_task, GoogleTasksError
 from server.config import TASKS_LIST_TITLE
-from sqlalchemy import select
+from sqlalchemy import func, select, tuple_
 
 tasks_bp = Blueprint('tasks', __name__)
 
@@ -21,15 +23,72 @@ def api_all_results():
     # Get optional query parameters
     category = request.values.get("category")
     sort = request.values.get("sort")
+    # Keyset pagination: pass the created_at and id of the last task received to get the next page.
+    # The id breaks ties between tasks created in the same dispatch batch
+    before_raw = request.values.get("before")
+    before_id_raw = request.values.get("before_id")
+    before = None
+    before_id = None
+    if before_raw or before_id_raw:
+        if sort == "category":
+            return jsonify({"error": "'before' paging follows created_at order and can't be combined with sort=category"}), 400
+        if not (before_raw and before_id_raw):
+            return jsonify({"error": "'before' and 'before_id' must be given together"}), 400
+        try:
+            before = datetime.fromisoformat(before_raw)
+            before_id = int(before_id_raw)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor. Expected an ISO 8601 'before' and an integer 'before_id'"}), 400
+        # Stored timestamps are UTC without an offset
+        if before.tzinfo is not None:
+            before = before.astimezone(timezone.utc).replace(tzinfo=None)
 
     try:
         with db_session() as s:
+            # Tasks are only ever added, deleted or confirmed (pending -> created), so this summary
+            # changes whenever the listing would; unchanged polls get a 304 without building it
+            summary = s.execute(
+                select(
+                    func.count(Task.id),
+                    func.max(Task.id),
+                    func.max(Task.created_at),
+                    func.count(Task.id).filter(Task.status == "created"),
+                ).where(Task.user_id == user_id)
+            ).one()
+            etag = hashlib.blake2b(
+                repr((tuple(summary), category, sort, before_raw, before_id_raw)).encode("utf-8"), digest_size=16
+            ).hexdigest()
+            if etag in request.if_none_match:
+                response = current_app.response_class(status=304)
+                response.set_etag(etag)
+                response.headers["Cache-Control"] = "private, no-cache"
+                return response
+
+            # Only the columns the response uses, so rows come back as tuples without building ORM objects.
+            # The few metadata fields are extracted by the database rather than decoding each JSON blob
+            md = Task.provider_metadata
             stmt = (
-                select(Task, Email)
+                select(
+                    Task.id,
+                    Task.provider,
+                    Task.provider_task_id,
+                    md["title"].as_string(),
+                    md[("payload", "subject")].as_string(),
+                    md["webLink"].as_string(),
+                    md["selfLink"].as_string(),
+                    md["due"].as_string(),
+                    Task.status,
+                    Task.category,
+                    Task.created_at,
+                    Email.subject,
+                    Email.sender,
+                    Email.received_at,
+                )
                 .join(Email, Email.id == Task.email_id)
                 .where(Task.user_id == user_id)
-                .where(Email.user_id == user_id)
             )
+            if before is not None:
+                stmt = stmt.where(tuple_(Task.created_at, Task.id) < tuple_(before, before_id))
             
             # Apply category filter if provided
             if category:
@@ -37,39 +96,39 @@ def api_all_results():
             
             # Apply sorting
             if sort == "category":
-                stmt = stmt.order_by(Task.category.asc(), Task.created_at.desc())
+                stmt = stmt.order_by(Task.category.asc(), Task.created_at.desc(), Task.id.desc())
             else:
-                stmt = stmt.order_by(Task.created_at.desc())
+                # The id tiebreak matches the cursor; the index already orders ties by rowid
+                stmt = stmt.order_by(Task.created_at.desc(), Task.id.desc())
             
             stmt = stmt.limit(200)
-            rows = s.execute(stmt).all()
             items = []
-            for row in rows:
-                t, e = row
-                md = t.provider_metadata or {}
+            for (task_id, provider, provider_task_id, task_title, payload_subject, web_link, self_link, task_due,
+                 status, task_category, created_at, email_subject, email_sender, email_received_at) in s.execute(stmt):
                 # For pending tasks, title is in metadata directly; for created tasks, it's in provider response
-                task_title = md.get("title")
-                if not task_title and t.status == "pending":
+                if not task_title and status == "pending":
                     # For pending tasks, check if there's a payload with subject
-                    payload = md.get("payload", {})
-                    task_title = payload.get("subject") or e.subject
-                task_link = md.get("webLink") or md.get("selfLink")
-                task_due = md.get("due")
+                    task_title = payload_subject or email_subject
+                task_link = web_link or self_link
                 items.append({
-                    "id": t.id,
-                    "provider": t.provider,
-                    "provider_task_id": t.provider_task_id,
-                    "created_at": t.created_at.isoformat() if t.created_at else "",
-                    "email_subject": e.subject,
-                    "email_sender": e.sender,
-                    "email_received_at": e.received_at.isoformat() if e.received_at else "",
+                    "id": task_id,
+                    "provider": provider,
+                    "provider_task_id": provider_task_id,
+                    "created_at": created_at.isoformat() if created_at else "",
+                    "email_subject": email_subject,
+                    "email_sender": email_sender,
+                    "email_received_at": email_received_at.isoformat() if email_received_at else "",
                     "task_title": task_title,
                     "task_link": task_link,
                     "task_due": task_due,
-                    "status": t.status or "created",
-                    "category": t.category,
+                    "status": status or "created",
+                    "category": task_category,
                 })
-        return jsonify({"tasks": items, "total": len(items)})
+        response = jsonify({"tasks": items, "total": len(items)})
+        response.set_etag(etag)
+        # Per-user data; browsers may store it but must revalidate with If-None-Match on each poll
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
     except Exception as e:
         return jsonify({"error": "Failed to fetch tasks"}), 500
 
@@ -4,8 +4,12 @@ Test script for ML classification and task generation.
 Usage: python3 test_ml.py
 """
 
-from server.ml import classify_and_generate_task, clean_html_to_text
+import server.ml as ml
+from server.ml import RateLimiter, classify_and_generate_task, clean_html_to_text, ml_decide_batch
+import json
 import os
+import re
+from types import SimpleNamespace
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -141,5 +145,156 @@ def test_classification():
     print("=" * 80)
 
 
+def test_clean_html_to_text_separates_cells_and_inline_siblings():
+    """Table cells and adjacent inline elements must not run together."""
+    html = """
+    <html><body>
+        <table>
+            <tr><th>Item</th><th>Price</th></tr>
+            <tr><td>Amount</td><td>$50</td></tr>
+        </table>
+        <dl><dt>Due</dt><dd>Friday</dd></dl>
+        <p><a href="#">Home</a><a href="#">About</a><span>Help</span></p>
+        <p>Hi <b>Bob</b>, thanks</p>
+    </body></html>
+    """
+    lines = clean_html_to_text(html).split("\n")
+    for text in ("Item", "Price", "Amount", "$50", "Due", "Friday"):
+        assert text in lines
+    assert "Home About Help" in lines
+    assert "Hi Bob, thanks" in lines
+
+
+
+def test_rate_limiter_refills_and_waits():
+    """The buckets refill with elapsed time and acquire() sleeps exactly the shortfall."""
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    limiter = RateLimiter(60, 600, clock=lambda: now[0], sleep=sleep)
+
+    # A full bucket covers a burst up to the per-minute limits without waiting
+    limiter.acquire(300)
+    limiter.acquire(300)
+    assert sleeps == []
+
+    # The token bucket is empty: 60 tokens at 600/min refill in 6 seconds
+    limiter.acquire(60)
+    assert sleeps == [6.0]
+
+    # After 30 idle seconds half the token bucket is back, so this fits immediately
+    now[0] += 30
+    limiter.acquire(300)
+    assert sleeps == [6.0]
+
+    # A call larger than the bucket is capped at the bucket size instead of waiting forever
+    limiter.acquire(10_000)
+    assert sleeps == [6.0, 60.0]
+
+
+def test_rate_limiter_request_bucket():
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    limiter = RateLimiter(2, 0, clock=lambda: now[0], sleep=sleep)
+    limiter.acquire(1_000_000)
+    limiter.acquire(1_000_000)
+    assert sleeps == []
+
+    # Both requests are spent; one refills in 60 / 2 = 30 seconds
+    limiter.acquire(1)
+    assert sleeps == [30.0]
+
+
+
+EMAIL_BLOCK_RE = re.compile(r'^Email (?:#(\d+)|Details):\nFrom: .*\nSubject: (.*)$', re.MULTILINE)
+
+
+def fake_completions(monkeypatch, batch_items=None):
+    """
+    Replace request_completion with a fake that answers from the prompt it is sent.
+
+    Each parsed email is a (index, subject) pair. batch_items(emails) returns the
+    "results" list for a batched request; by default every email is answered in
+    order. Single-email requests are answered directly. Returns the list of calls.
+    """
+    calls = []
+
+    def item(index, subject):
+        return {"index": index, "should_create": True, "confidence": 0.8, "title": f"Task: {subject}", "notes": "", "reasoning": "ok"}
+
+    def request_completion(api_key, model, system_prompt, user_prompt, max_tokens, response_format):
+        emails = [(int(index) if index else None, subject) for index, subject in EMAIL_BLOCK_RE.findall(user_prompt)]
+        calls.append([subject for _, subject in emails])
+        if response_format is ml.BATCH_RESPONSE_SCHEMA:
+            body = {"results": (batch_items or (lambda emails: [item(*email) for email in emails]))(emails)}
+        else:
+            body = item(*emails[0])
+            del body["index"]
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(body)))])
+
+    monkeypatch.setattr(ml, "OPENAI_AVAILABLE", True)
+    monkeypatch.setattr(ml, "request_completion", request_completion)
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    for name in ("OPENAI_MODEL", "OPENAI_MODEL_FAST", "OPENAI_BATCH_SIZE", "OPENAI_HEURISTIC_PREFILTER"):
+        monkeypatch.delenv(name, raising=False)
+    ml._classification_cache.clear()
+    return calls
+
+
+def email(subject, sender="alice@example.com"):
+    return {"subject": subject, "sender": sender, "body": f"Please handle this: {subject}. Thanks!"}
+
+
+def test_batch_results_are_matched_by_index_not_position(monkeypatch):
+    calls = fake_completions(monkeypatch, lambda emails: [
+        {"index": index, "title": f"Task: {subject}", "should_create": True, "confidence": 0.8}
+        for index, subject in reversed(emails)
+    ])
+    results = ml_decide_batch([email("Send invoice"), email("Book flights"), email("Review draft")])
+    assert [r["title"] for r in results] == ["Task: Send invoice", "Task: Book flights", "Task: Review draft"]
+    assert len(calls) == 1
+
+
+def test_batch_missing_index_falls_back_to_single_request(monkeypatch):
+    calls = fake_completions(monkeypatch, lambda emails: [
+        {"index": index, "title": f"Task: {subject}"} for index, subject in emails if index != 2
+    ])
+    results = ml_decide_batch([email("Send invoice"), email("Book flights"), email("Review draft")])
+    assert [r["title"] for r in results] == ["Task: Send invoice", "Task: Book flights", "Task: Review draft"]
+    assert calls == [["Send invoice", "Book flights", "Review draft"], ["Book flights"]]
+
+
+def test_duplicate_emails_are_classified_once(monkeypatch):
+    calls = fake_completions(monkeypatch)
+    results = ml_decide_batch([email("Send invoice"), email("Book flights"), email("Send invoice")])
+    assert calls == [["Send invoice", "Book flights"]]
+    assert results[2] == results[0]
+    # Each caller gets its own dict, so editing one result cannot change another
+    assert results[2] is not results[0]
+
+
+def test_short_circuited_emails_are_not_sent(monkeypatch):
+    calls = fake_completions(monkeypatch)
+    results = ml_decide_batch([
+        email("Send invoice"),
+        {"subject": "Hi", "sender": "bob@example.com", "body": ""},
+        email("Automatic reply: out until Monday"),
+        email("Book flights"),
+    ])
+    assert calls == [["Send invoice", "Book flights"]]
+    assert results[1]["reasoning"] == "Insufficient content"
+    assert results[2]["reasoning"] == "Heuristic: auto-reply"
+    assert [results[0]["title"], results[3]["title"]] == ["Task: Send invoice", "Task: Book flights"]
+
+
 if __name__ == "__main__":
     test_classification()
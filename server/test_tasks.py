@@ -0,0 +1,132 @@
+"""
+Tests for GET /tasks/all paging and conditional responses.
+Runs against an in-memory SQLite database; nothing touches taskflow.db.
+"""
+
+import itertools
+import os
+
+# server.config refuses to import without OAuth client settings
+os.environ.setdefault(
+    "GOOGLE_CLIENT_SECRETS_JSON",
+    '{"web": {"client_id": "test", "client_secret": "test", "auth_uri": "https://auth.test", "token_uri": "https://token.test"}}',
+)
+
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import server.db as db
+from server.db import Base, Email, Task, User
+from server.routers.tasks import tasks_bp
+from server.utils import encode_jwt
+
+USER_EMAIL = "alice@example.com"
+CREATED_AT = datetime(2026, 1, 1, 12, 0, 0)
+message_ids = itertools.count(1)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr(db, "SessionLocal", sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True))
+
+    app = Flask(__name__)
+    app.register_blueprint(tasks_bp)
+    test_client = app.test_client()
+    test_client.environ_base["HTTP_AUTHORIZATION"] = f"Bearer {encode_jwt(USER_EMAIL)}"
+    yield test_client
+    engine.dispose()
+
+
+def add_tasks(created_ats, status="created"):
+    """Insert one task per timestamp, in order, and return their ids."""
+    with db.db_session() as s:
+        user = s.query(User).filter_by(email=USER_EMAIL).one_or_none()
+        if user is None:
+            user = User(email=USER_EMAIL)
+            s.add(user)
+            s.flush()
+        ids = []
+        for created_at in created_ats:
+            email = Email(user_id=user.id, gmail_message_id=f"msg-{next(message_ids)}", subject="Subject")
+            s.add(email)
+            s.flush()
+            task = Task(user_id=user.id, email_id=email.id, provider="google_tasks", status=status, provider_metadata={}, created_at=created_at)
+            s.add(task)
+            s.flush()
+            ids.append(task.id)
+        return ids
+
+
+def page(client, **params):
+    response = client.get("/tasks/all", query_string=params)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()["tasks"]
+
+
+def test_cursor_pages_through_tasks_with_tied_created_at(client):
+    # Tasks from one dispatch batch share created_at, so only the id tiebreak keeps pages apart
+    ids = add_tasks([CREATED_AT] * 4 + [CREATED_AT - timedelta(minutes=1)] * 2)
+
+    first = page(client)
+    assert [t["id"] for t in first] == sorted(ids[:4], reverse=True) + sorted(ids[4:], reverse=True)
+
+    # Each cursor returns exactly the tasks after it, including the rest of its own tie
+    for position, cursor in enumerate(first):
+        tasks = page(client, before=cursor["created_at"], before_id=cursor["id"])
+        assert [t["id"] for t in tasks] == [t["id"] for t in first[position + 1:]]
+
+
+def test_cursor_accepts_utc_offset(client):
+    ids = add_tasks([CREATED_AT, CREATED_AT])
+    tasks = page(client, before=CREATED_AT.isoformat() + "+00:00", before_id=ids[1])
+    assert [t["id"] for t in tasks] == [ids[0]]
+
+
+@pytest.mark.parametrize("params", [
+    {"before": CREATED_AT.isoformat()},
+    {"before_id": "3"},
+    {"before": CREATED_AT.isoformat(), "before_id": "3", "sort": "category"},
+    {"before": "yesterday", "before_id": "3"},
+    {"before": CREATED_AT.isoformat(), "before_id": "three"},
+])
+def test_invalid_cursor_is_rejected(client, params):
+    add_tasks([CREATED_AT])
+    response = client.get("/tasks/all", query_string=params)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_unchanged_listing_returns_304(client):
+    add_tasks([CREATED_AT])
+    response = client.get("/tasks/all")
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "private, no-cache"
+
+    unchanged = client.get("/tasks/all", headers={"If-None-Match": etag})
+    assert unchanged.status_code == 304
+    assert unchanged.data == b""
+
+    # Other query parameters are a different listing
+    other = client.get("/tasks/all", query_string={"sort": "category"}, headers={"If-None-Match": etag})
+    assert other.status_code == 200
+
+
+def test_new_or_confirmed_task_changes_etag(client):
+    (task_id,) = add_tasks([CREATED_AT], status="pending")
+    etag = client.get("/tasks/all").headers["ETag"]
+
+    add_tasks([CREATED_AT])
+    response = client.get("/tasks/all", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    with db.db_session() as s:
+        s.get(Task, task_id).status = "created"
+    assert client.get("/tasks/all", headers={"If-None-Match": etag}).status_code == 200
@@ -1,17 +1,47 @@
 from __future__ import annotations
 import base64
+import logging
+import re
+import threading
+import weakref
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
 from typing import Tuple
-from functools import wraps
-from flask import session, request, jsonify
+from functools import lru_cache, wraps
+from flask import g, session, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 import jwt
 from server.config import FLASK_SECRET
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from bs4 import BeautifulSoup
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from bs4 import BeautifulSoup, SoupStrainer
 from sqlalchemy import select
 from server.db import db_session, User
 
+logger = logging.getLogger(__name__)
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+    SELECTOLAX_AVAILABLE = True
+except ImportError:
+    SELECTOLAX_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    # SIMD base64; accepts str directly, so no intermediate bytes copy
+    from pybase64 import urlsafe_b64decode
+except ImportError:
+    def urlsafe_b64decode(data: str) -> bytes:
+        return base64.urlsafe_b64decode(data.encode("utf-8"))
+
 # SCOPES: Gmail read-only + Google Tasks write
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.readonly",
@@ -19,6 +49,36 @@ SCOPES = [
     "https://www.googleapis.com/auth/calendar.events",
 ]
 
+# Only <body> is turned into text; skip building <head> (title, styles, meta) entirely
+BODY_STRAINER = SoupStrainer("body")
+# charset parameter of a Content-Type header, with or without quotes
+CHARSET_RE = re.compile(r"""charset\s*=\s*["']?([^"';\s]+)""", re.IGNORECASE)
+# Zero-width and soft-hyphen characters used as preheader padding in marketing emails
+ZERO_WIDTH_TABLE = dict.fromkeys(map(ord, "\u200b\u200c\u200d\u2060\ufeff\u034f\u00ad"), None)
+# Headers kept on the payload so server.ml can recognize bulk mail and auto-replies without a model call
+BULK_MAIL_HEADERS = ("list-unsubscribe", "list-id", "precedence", "auto-submitted", "x-autoreply", "x-autorespond")
+
+# LRU of converted Gmail messages, keyed by (message id, historyId); entries hold raw HTML, so keep it small
+PAYLOAD_CACHE_SIZE = 256
+_payload_cache: OrderedDict[tuple[str, str | None], dict] = OrderedDict()
+_payload_cache_lock = threading.Lock()
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson; types orjson can't encode fall back to Flask's default."""
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS if ORJSON_AVAILABLE else 0
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default, option=self.option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response instead of round-tripping through str
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.option)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 def encode_jwt(user_email: str) -> str:
     """Create a JWT token for a user."""
     payload = {
@@ -67,44 +127,119 @@ def require_auth(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def _get_credentials():
+def get_credentials():
+    # Memoized per request: several services are built from the same credentials
+    if "credentials" in g:
+        return g.credentials
+    g.credentials = _load_credentials()
+    return g.credentials
+
+def _load_credentials():
     if request and hasattr(request, 'user_email') and request.user_email:
-        with db_session() as s:
-            stmt = select(User).where(User.email == request.user_email)
-            user = s.execute(stmt).scalar_one_or_none()
-            if user and user.google_token:
-                creds_info = {
-                    "token": user.google_token,
-                    "refresh_token": user.google_refresh_token,
-                    "token_uri": user.google_token_uri,
-                    "client_id": user.google_client_id,
-                    "client_secret": user.google_client_secret,
-                    "scopes": user.google_scopes,
-                }
-                return Credentials.from_authorized_user_info(info=creds_info, scopes=SCOPES)
+        user = get_current_user()
+        if user and user.google_token:
+            creds = _user_credentials(user)
+            if creds.expired and creds.refresh_token:
+                creds = _refresh_user_credentials(user.email)
+            return creds
 
     creds_info = session.get("credentials")
     if not creds_info:
         return None
     return Credentials.from_authorized_user_info(info=creds_info, scopes=SCOPES)
 
+def _user_credentials(user: User) -> Credentials:
+    creds_info = {
+        "token": user.google_token,
+        "refresh_token": user.google_refresh_token,
+        "token_uri": user.google_token_uri,
+        "client_id": user.google_client_id,
+        "client_secret": user.google_client_secret,
+        "scopes": user.google_scopes,
+    }
+    creds = Credentials.from_authorized_user_info(info=creds_info, scopes=SCOPES)
+    expiry = user.google_token_expiry
+    creds.expiry = expiry.astimezone(timezone.utc).replace(tzinfo=None) if expiry and expiry.tzinfo else expiry
+    return creds
+
+class _RefreshLock:
+    """threading.Lock can't be weakly referenced; this wrapper can."""
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+# Per-user locks so concurrent requests with an expired token refresh it once instead of racing.
+# Entries vanish once no request holds or waits on them, so the map doesn't grow with every user seen
+_refresh_locks: weakref.WeakValueDictionary[str, _RefreshLock] = weakref.WeakValueDictionary()
+_refresh_locks_guard = threading.Lock()
+
+def _refresh_user_credentials(email: str) -> Credentials:
+    """Refresh a user's access token and store it, unless another request already did."""
+    with _refresh_locks_guard:
+        lock = _refresh_locks.get(email)
+        if lock is None:
+            lock = _refresh_locks[email] = _RefreshLock()
+    # The local name keeps the lock alive while this request waits on or holds it
+    with lock, db_session() as s:
+        # Re-read under the lock: a request that held it may have stored a fresh token
+        user = s.execute(select(User).where(User.email == email)).scalar_one()
+        creds = _user_credentials(user)
+        if not creds.expired:
+            return creds
+        # A fresh transport per refresh: requests.Session isn't documented as thread-safe, and
+        # refreshes happen about once an hour per user, so there is little connection reuse to lose
+        auth_request = GoogleAuthRequest()
+        try:
+            creds.refresh(auth_request)
+        except RefreshError as e:
+            # Leave the stored token alone; the API call reports the failure as before
+            logger.warning("Google token refresh failed for %s: %s", email, e)
+            return creds
+        finally:
+            auth_request.session.close()
+        user.google_token = creds.token
+        user.google_token_expiry = creds.expiry
+        if creds.refresh_token:
+            user.google_refresh_token = creds.refresh_token
+        user.updated_at = datetime.now(timezone.utc)
+        return creds
+
+@lru_cache(maxsize=None)
+def _discovery_document(api: str, version: str) -> str:
+    """Read the bundled discovery document once per process instead of on every build().
+
+    The raw JSON is cached rather than the parsed dict: build_from_document
+    mutates the dict it is given (it expands method parameters on first use),
+    and services are built concurrently from several threads.
+    """
+    return get_static_doc(api, version)
+
+def build_service(api: str, version: str, credentials):
+    return build_from_document(_discovery_document(api, version), credentials=credentials)
+
 def get_gmail_service():
-    creds = _get_credentials()
+    creds = get_credentials()
     if not creds:
         return None
-    return build("gmail", "v1", credentials=creds)
+    return build_service("gmail", "v1", creds)
 
 def get_tasks_service():
-    creds = _get_credentials()
+    creds = get_credentials()
     if not creds:
         return None
-    return build("tasks", "v1", credentials=creds)
+    return build_service("tasks", "v1", creds)
 
 def get_calendar_service():
-    creds = _get_credentials()
+    creds = get_credentials()
     if not creds:
         return None
-    return build("calendar", "v3", credentials=creds)
+    return build_service("calendar", "v3", creds)
 
 def get_or_create_user(session, email: str) -> User:
     """Get or create a user by email address."""
@@ -126,75 +261,117 @@ def get_current_user() -> User | None:
     if not hasattr(request, 'user_email'):
         return None
     
+    # Loaded once per request and shared by every helper that needs the user row
+    user = g.get("current_user")
+    if user is not None:
+        return user
+
     user_email = request.user_email
     with db_session() as s:
         user = get_or_create_user(s, user_email)
         _ = user.id
         s.expunge(user)
-        return user
+    g.current_user = user
+    return user
 
-def get_header(payload: dict, name: str) -> str | None:
-    for header in payload.get("headers", []):
-        if header.get("name", "").lower() == name.lower():
-            return header.get("value")
-    return None
+def index_headers(headers: list[dict] | None) -> dict[str, str]:
+    """Map lowercased header names to values, keeping the first occurrence like a linear scan would."""
+    index: dict[str, str] = {}
+    for header in headers or []:
+        name = header.get("name")
+        if name:
+            index.setdefault(name.lower(), header.get("value"))
+    return index
+
+def part_charset(headers: dict[str, str]) -> str:
+    match = CHARSET_RE.search(headers.get("content-type") or "")
+    return match.group(1).lower() if match else "utf-8"
 
 def decode_part_text(part: dict) -> str:
     body = part.get("body", {})
     data = body.get("data")
     if not data:
         return ""
-    raw = base64.urlsafe_b64decode(data.encode("utf-8"))
-    charset = "utf-8"
-    for header in part.get("headers", []):
-        if header.get("name", "").lower() == "content-type":
-            value = header.get("value", "")
-            lower = value.lower()
-            if "charset=" in lower:
-                charset = lower.split("charset=", 1)[1]
-                if ";" in charset:
-                    charset = charset.split(";", 1)[0]
-                charset = charset.strip().strip('"').strip("'")
-                break
+    raw = urlsafe_b64decode(data)
+    charset = part_charset(index_headers(part.get("headers")))
     try:
         return raw.decode(charset, errors="replace")
     except Exception:
         return raw.decode("utf-8", errors="replace")
 
+def first_nonblank_text(parts: list[dict]) -> str:
+    """Decode parts in order and return the first one with non-whitespace content."""
+    for part in parts:
+        text = decode_part_text(part)
+        if text.strip():
+            return text
+    return ""
+
 def gather_bodies(payload: dict) -> Tuple[str, str]:
-    texts: list[str] = []
-    htmls: list[str] = []
+    # Collect leaf parts first and decode lazily, so parts after the first usable one are never decoded
+    text_parts: list[dict] = []
+    html_parts: list[dict] = []
 
-    def walk(part: dict):
-        mime = (part.get("mimeType") or "").lower()
+    # Iterative depth-first walk; children are pushed reversed to keep document order
+    stack = [payload] if payload else []
+    while stack:
+        part = stack.pop()
         if part.get("parts"):
-            for child in part["parts"]:
-                walk(child)
-            return
+            stack.extend(reversed(part["parts"]))
+            continue
+        mime = (part.get("mimeType") or "").lower()
         if mime.startswith("text/plain"):
-            texts.append(decode_part_text(part))
+            text_parts.append(part)
         elif mime.startswith("text/html"):
-            htmls.append(decode_part_text(part))
+            html_parts.append(part)
 
-    if payload:
-        walk(payload)
-
-    text = next((t for t in texts if t.strip()), "")
-    html = next((h for h in htmls if h.strip()), "")
-    return text, html
+    return first_nonblank_text(text_parts), first_nonblank_text(html_parts)
 
 def html_to_text(html: str) -> str:
     if not html:
         return ""
-    soup = BeautifulSoup(html, "lxml")
+    if SELECTOLAX_AVAILABLE:
+        tree = LexborHTMLParser(html)
+        tree.strip_tags(["script", "style", "noscript", "template"])
+        for br in tree.css("br"):
+            br.replace_with("\n")
+        root = tree.body or tree.root
+        return root.text(separator="\n").strip() if root else ""
+    soup = BeautifulSoup(html, "lxml", parse_only=BODY_STRAINER)
     for br in soup.find_all("br"):
         br.replace_with("\n")
     return soup.get_text("\n").strip()
 
+def strip_invisible(text: str) -> str:
+    """Drop zero-width characters in one C-level pass."""
+    return text.translate(ZERO_WIDTH_TABLE) if text else ""
+
 def message_to_payload(message: dict) -> dict:
+    """
+    Convert a Gmail message into the payload dict used for classification and task creation.
+    Results are cached by (id, historyId) since the conversion is pure; callers get a copy they may mutate.
+    """
+    message_id = message.get("id")
+    if not message_id:
+        return _message_to_payload(message)
+    key = (message_id, message.get("historyId") or message.get("internalDate"))
+    with _payload_cache_lock:
+        cached = _payload_cache.get(key)
+        if cached is not None:
+            _payload_cache.move_to_end(key)
+            return dict(cached)
+
+    payload = _message_to_payload(message)
+    with _payload_cache_lock:
+        _payload_cache[key] = payload
+        if len(_payload_cache) > PAYLOAD_CACHE_SIZE:
+            _payload_cache.popitem(last=False)
+    return dict(payload)
+
+def _message_to_payload(message: dict) -> dict:
     payload = message.get("payload", {})
     text_body, html_body = gather_bodies(payload)
-    body = text_body or html_to_text(html_body)
+    body = strip_invisible(text_body or html_to_text(html_body))
 
     internal = message.get("internalDate")
     received_at = None
@@ -204,13 +381,17 @@ def message_to_payload(message: dict) -> dict:
         except Exception:
             received_at = None
 
+    headers = index_headers(payload.get("headers"))
     return {
-        "subject": get_header(payload, "Subject") or "(No subject)",
-        "sender": get_header(payload, "From") or "",
+        "subject": headers.get("subject") or "(No subject)",
+        "sender": headers.get("from") or "",
         "received_at": received_at,
         "body": body.strip(),
         "html": html_body, 
+        # body already holds the text of html_body; consumers should not parse it again
+        "html_converted": bool(html_body) and not text_body,
         "snippet": message.get("snippet", ""),
         "thread_id": message.get("threadId", ""),
+        "headers": {name: headers[name] for name in BULK_MAIL_HEADERS if name in headers},
     }
 